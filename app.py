@@ -1,11 +1,16 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, has_request_context
+from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from functools import wraps
-from models import Usuario, Livro, Emprestimo, Doacao, UserType, QRCodeType, QRCodeData
-from utils import DatabaseSingleton, QRCodeGenerator, CreditSystem, Logger, LivroFactory, QRCodeProcessor
+from models import Livro, Emprestimo, Doacao, UserType, QRCodeType, QRCodeData
+from cliente_quiosque import CABECALHO_ASSINATURA, assinar
+from utils import DatabaseSingleton, QRCodeGenerator, CreditSystem, Logger, LivroFactory, QRCodeProcessor, BcryptPool, PoolSobrecarregado, LoginThrottle, QRCodePNGCache
 import os
 import io
 import qrcode
+import hashlib
+import hmac
+import time
 from datetime import datetime
 
 
@@ -24,10 +29,22 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 app.jinja_env.filters['format_datetime'] = format_datetime
 app.jinja_env.globals['UserType'] = UserType
 
+# BIBLIOTECA_ENGINE (csv ou sqlite) pode vir do ambiente ou de um arquivo .env
+load_dotenv()
 db = DatabaseSingleton.instance()
+# Usuários lidos ficam em g durante a requisição: load_user, inject_user,
+# moderador_required e CreditSystem compartilham a mesma leitura
+db.usar_mapa_de_identidade(lambda: g.setdefault('usuarios', {}) if has_request_context() else None)
 credit_system = CreditSystem()
 logger = Logger()
-qr_processor = QRCodeProcessor()
+# bcrypt roda em um pool limitado para não prender as threads das requisições
+bcrypt_pool = BcryptPool()
+login_throttle = LoginThrottle()
+qr_cache = QRCodePNGCache()
+db.observar(qr_cache.ao_confirmar)
+# QR Codes gerados na mesma janela (segundos) têm o mesmo conteúdo e são reaproveitados
+QR_JANELA = 300
+qr_processor = QRCodeProcessor.instance()
 print("QRCodeProcessor inicializado com estratégias:", [s.__class__.__name__ for s in qr_processor.strategies.values()])
 
 
@@ -65,6 +82,12 @@ def inject_user():
     return {}
 
 
+@app.errorhandler(PoolSobrecarregado)
+def servidor_ocupado(e):
+    flash('Servidor ocupado, tente novamente em instantes', 'warning')
+    return render_template('cadastrologin.html'), 503, {'Retry-After': '1'}
+
+
 @app.before_request
 def load_user():
     g.user = None
@@ -91,14 +114,25 @@ def login():
             if db.get_usuario_by_email(email):
                 flash('Email já cadastrado!', 'error')
             else:
-                novo_usuario = Usuario.criar_usuario(email, senha)
+                novo_usuario = bcrypt_pool.criar_usuario(email, senha)
                 db.adicionar_usuario(novo_usuario)
-                credit_system.adicionar_creditos(novo_usuario.id, 6)
+                credit_system.adicionar_creditos(novo_usuario.id, 6, motivo='cadastro')
                 flash('Cadastro realizado com sucesso!', 'success')
                 return redirect(url_for('login'))
         else:
+            # Antes de qualquer leitura ou bcrypt
+            if not login_throttle.permitir(request.remote_addr, email):
+                flash('Muitas tentativas de login, aguarde um pouco', 'error')
+                return render_template('cadastrologin.html'), 429
+
             usuario = db.get_usuario_by_email(email)
-            if usuario and usuario.verificar_senha(senha):
+            if usuario and bcrypt_pool.verificar_senha(usuario, senha):
+                if bcrypt_pool.precisa_rehash(usuario):
+                    # O custo configurado mudou: regrava o hash enquanto temos a senha
+                    try:
+                        db.atualizar_senha_hash(usuario.id, bcrypt_pool.gerar_hash(senha))
+                    except PoolSobrecarregado:
+                        pass
                 session.clear()
                 session['user_id'] = usuario.id
                 return redirect(url_for('index'))
@@ -118,55 +152,71 @@ def emprestimo():
     if request.method == 'POST':
         if 'solicitar' in request.form:
             livro_id = int(request.form.get('livro_id', 0))
-            if credit_system.tem_creditos_suficientes(g.user.id, 3):
-                emprestimo = Emprestimo.criar_emprestimo(g.user.id, livro_id)
-                if db.adicionar_emprestimo(emprestimo):
-                    credit_system.deduzir_creditos(g.user.id, 3)
-                    flash('Empréstimo solicitado com sucesso!', 'success')
-                else:
-                    flash('Erro ao processar empréstimo', 'error')
-            else:
-                flash('Créditos insuficientes!', 'error')
+            emprestimo = Emprestimo.criar_emprestimo(g.user.id, livro_id)
+            sucesso, mensagem = db.solicitar_emprestimo(emprestimo, custo=3)
+            flash(mensagem, 'success' if sucesso else 'error')
 
         elif 'cancelar' in request.form:
             emprestimo_id = int(request.form.get('emprestimo_id', 0))
             if db.cancelar_emprestimo(emprestimo_id):
-                credit_system.adicionar_creditos(g.user.id, 3)
+                credit_system.adicionar_creditos(g.user.id, 3, motivo='cancelamento')
                 flash('Empréstimo cancelado!', 'success')
             else:
                 flash('Erro ao cancelar empréstimo', 'error')
 
-    livros = [livro for livro in db.get_livros_disponiveis() if livro.aprovado]
+    busca = {campo: request.args.get(campo, '').strip() for campo in ('q', 'genero', 'autor')}
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = min(max(request.args.get('page_size', 20, type=int), 1), 100)
+
+    livros, total = db.buscar_livros(page=page, page_size=page_size, **busca)
+    paginas = max((total + page_size - 1) // page_size, 1)
     emprestimos = db.get_emprestimos_por_usuario(g.user.id)
-    return render_template('emprestimo.html', livros=livros, emprestimos=emprestimos)
+    return render_template('emprestimo.html', livros=livros, emprestimos=emprestimos,
+                           busca=busca, page=page, page_size=page_size, paginas=paginas, total=total)
 
 @app.route('/gerar_qrcode/<tipo>/<int:object_id>')
 @login_required
 def gerar_qrcode(tipo, object_id):
     try:
         qr_type = QRCodeType[tipo.upper()]
+        agora = time.time()
+        janela = int(agora // QR_JANELA) * QR_JANELA
         qr_data = QRCodeData(
             qr_type=qr_type,
             object_id=object_id,
-            user_id=g.user.id
+            user_id=g.user.id,
+            timestamp=float(janela)
         ).serialize()
 
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_H,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        logger.log(f"QRCode gerado para {tipo}: {object_id}")
-        return send_file(buffer, mimetype='image/png')
+        # O PNG é função do conteúdo, então o ETag sai dele sem renderizar nada
+        etag = hashlib.sha256(qr_data.encode()).hexdigest()[:32]
+        if request.if_none_match.contains(etag):
+            resposta = app.response_class(status=304)
+        else:
+            chave = (qr_type.name, object_id, g.user.id, janela)
+            png = qr_cache.get(chave)
+            if png is None:
+                qr = qrcode.QRCode(
+                    version=1,
+                    error_correction=qrcode.constants.ERROR_CORRECT_H,
+                    box_size=10,
+                    border=4,
+                )
+                qr.add_data(qr_data)
+                qr.make(fit=True)
+
+                img = qr.make_image(fill_color="black", back_color="white")
+                buffer = io.BytesIO()
+                img.save(buffer, format="PNG")
+                png = buffer.getvalue()
+                qr_cache.put(chave, png)
+                logger.log(f"QRCode gerado para {tipo}: {object_id}")
+            resposta = app.response_class(png, mimetype='image/png')
+
+        resposta.set_etag(etag)
+        resposta.cache_control.private = True
+        resposta.cache_control.max_age = int(janela + QR_JANELA - agora)
+        return resposta
 
     except KeyError:
         flash('Tipo de QR Code inválido', 'error')
@@ -258,16 +308,67 @@ def banir_usuario(usuario_id):
     return redirect(url_for('requisicoes'))
 
 
+@app.route('/api/login_throttle')
+@moderador_required
+def api_login_throttle():
+    return login_throttle.estatisticas()
+
+
 @app.route('/api/process_qr', methods=['POST'])
 def api_process_qr():
     qr_data_str = request.json.get('qr_data')
     if not qr_data_str:
         return {'success': False, 'message': 'Dados inválidos'}, 400
 
-    success, message = QRCodeProcessor().process(qr_data_str)
+    success, message = qr_processor.process(qr_data_str)
     return {'success': success, 'message': message}
 
 
+# Limite de leituras por chamada de /api/process_qr/batch
+MAX_LOTE_QR = 500
+# Segredo compartilhado com os quiosques; sem ele, lidos_em é sempre ignorado
+SEGREDO_QUIOSQUE = os.environ.get('BIBLIOTECA_QUIOSQUE_SEGREDO', '')
+
+
+def requisicao_de_quiosque():
+    """Se o corpo da requisição foi assinado com o segredo dos quiosques"""
+    if not SEGREDO_QUIOSQUE:
+        return False
+    return hmac.compare_digest(request.headers.get(CABECALHO_ASSINATURA, ''),
+                               assinar(SEGREDO_QUIOSQUE, request.get_data()))
+
+
+@app.route('/api/process_qr/batch', methods=['POST'])
+def api_process_qr_batch():
+    """Recebe {'qr_data': [...], 'lidos_em': [...]}, por exemplo leituras acumuladas
+    por um quiosque offline. lidos_em (opcional) é o timestamp de cada leitura e
+    só vale em requisições assinadas por um quiosque; nas demais a validade é
+    conferida com a hora do servidor"""
+    payload = request.get_json(silent=True) or {}
+    leituras = payload.get('qr_data')
+    lidos_em = payload.get('lidos_em')
+    if not isinstance(leituras, list) or not all(isinstance(l, str) and l for l in leituras):
+        return {'success': False, 'message': 'Dados inválidos'}, 400
+    if lidos_em is not None and (not isinstance(lidos_em, list) or len(lidos_em) != len(leituras)
+                                 or not all(isinstance(t, (int, float)) for t in lidos_em)):
+        return {'success': False, 'message': 'Dados inválidos'}, 400
+    if len(leituras) > MAX_LOTE_QR:
+        return {'success': False, 'message': f'No máximo {MAX_LOTE_QR} leituras por lote'}, 413
+
+    if lidos_em is not None and not requisicao_de_quiosque():
+        lidos_em = None
+    if lidos_em is not None:
+        # Nunca no futuro e nunca antes do atraso máximo aceito
+        agora = time.time()
+        atraso = QRCodeProcessor.ATRASO_MAXIMO_OFFLINE
+        lidos_em = [min(max(t, agora - atraso), agora) for t in lidos_em]
+    resultados = qr_processor.process_batch(leituras, lidos_em)
+    return {
+        'success': all(success for success, _ in resultados),
+        'resultados': [{'success': success, 'message': message} for success, message in resultados]
+    }
+
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -0,0 +1,84 @@
+from models import QRCodeData, QRCodeType
+import argparse
+import random
+import time
+import cv2
+import numpy as np
+import qrcode
+
+# Tamanhos (em pixels) que o QR Code ocupa no quadro 640x480 da câmera do quiosque.
+# Abaixo disso o desfoque 5x5 do quiosque apaga os módulos de qualquer versão.
+TAMANHOS = (160, 175, 190, 205, 220, 235)
+
+
+def renderizar(payload):
+    """Mesmos parâmetros da rota /gerar_qrcode"""
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    img = np.array(qr.make_image(fill_color="black", back_color="white").convert('L'))
+    return img, qr.version
+
+
+def simular_camera(img, tamanho, rng):
+    """Coloca o código reduzido em um quadro 640x480 com desfoque e ruído"""
+    # Variação de alguns pixels para não medir só o aliasing de uma escala exata
+    tamanho += rng.randint(-7, 7)
+    codigo = cv2.resize(img, (tamanho, tamanho), interpolation=cv2.INTER_AREA)
+    frame = np.full((480, 640), 170, dtype=np.uint8)
+    x = rng.randint(0, 640 - tamanho)
+    y = rng.randint(0, 480 - tamanho)
+    frame[y:y + tamanho, x:x + tamanho] = codigo
+    frame = cv2.GaussianBlur(frame, (3, 3), 0.8)
+    ruido = np.random.default_rng(rng.randint(0, 2 ** 32)).normal(0, 12, frame.shape)
+    return cv2.cvtColor(np.clip(frame + ruido, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+
+def decodificar(detector, frame):
+    """Desfoque + Otsu no frame inteiro, o pré-processamento original do quiosque"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    retval, decoded_info, _, _ = detector.detectAndDecodeMulti(thresh)
+    return decoded_info[0] if retval and decoded_info else ''
+
+
+def executar(amostras, semente):
+    rng = random.Random(semente)
+    detector = cv2.QRCodeDetector()
+    dados = [
+        QRCodeData(rng.choice(list(QRCodeType)), rng.randint(1, 50000), rng.randint(1, 5000),
+                   time.time() - rng.random() * 86400)
+        for _ in range(amostras)
+    ]
+
+    for nome, compacto in (('texto', False), ('compacto', True)):
+        payloads = [d.serialize(compacto=compacto) for d in dados]
+        imagens = [renderizar(p) for p in payloads]
+        versoes = sorted({versao for _, versao in imagens})
+        print(f"{nome}: {max(len(p) for p in payloads)} caracteres, versão QR {versoes}")
+
+        total = 0
+        for tamanho in TAMANHOS:
+            lidos = 0
+            inicio = time.perf_counter()
+            for payload, (img, _) in zip(payloads, imagens):
+                lido = decodificar(detector, simular_camera(img, tamanho, rng))
+                lidos += lido == payload and QRCodeData.deserialize(lido) is not None
+            ms = (time.perf_counter() - inicio) * 1000 / amostras
+            total += lidos
+            print(f"  {tamanho:4d}px: {100.0 * lidos / amostras:5.1f}% lidos, {ms:.1f} ms/quadro")
+        print(f"  total: {100.0 * total / (amostras * len(TAMANHOS)):5.1f}% lidos")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compara a leitura dos formatos de QR Code no quiosque")
+    parser.add_argument('--amostras', type=int, default=100)
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args()
+    executar(args.amostras, args.semente)
@@ -0,0 +1,128 @@
+from leitor_qr import LeitorQR
+from models import QRCodeData
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy as np
+
+EXTENSOES = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+class ProcessadorSomenteLeitura:
+    """Confere só o formato e a assinatura do QR Code, sem ler nem alterar o
+    armazenamento (os códigos de uma gravação já estão expirados ou usados)"""
+
+    def process(self, qr_data_str):
+        if QRCodeData.deserialize(qr_data_str) is None:
+            return False, "QR Code inválido ou corrompido"
+        return True, "QR Code lido"
+
+
+def ler_frames(origem):
+    """Frames de um vídeo (via cv2.VideoCapture) ou das imagens de uma pasta, em
+    ordem de nome, no mesmo tamanho da thread de captura do quiosque"""
+    if os.path.isdir(origem):
+        for arquivo in sorted(os.listdir(origem)):
+            if arquivo.lower().endswith(EXTENSOES):
+                frame = cv2.imread(os.path.join(origem, arquivo))
+                if frame is not None:
+                    yield cv2.resize(frame, (640, 480))
+        return
+
+    captura = cv2.VideoCapture(origem)
+    if not captura.isOpened():
+        print(f"Não foi possível abrir o vídeo: {origem}")
+        return
+    try:
+        while True:
+            ret, frame = captura.read()
+            if not ret:
+                break
+            yield cv2.resize(frame, (640, 480))
+    finally:
+        captura.release()
+
+
+def executar(origem, processar=False, decodificadores=None):
+    """Passa todos os frames pelo processar_frame do quiosque e devolve as métricas.
+
+    Diferente do quiosque, não há pausa depois de um resultado: todo frame é
+    analisado, e só o debounce (LeiturasRecentes) evita reprocessar o código.
+    """
+    if not os.path.exists(origem):
+        print(f"Origem não encontrada: {origem}")
+        return None
+
+    leitor = LeitorQR(None if processar else ProcessadorSomenteLeitura(),
+                      ordem_decodificadores=decodificadores)
+
+    latencias = []
+    lidos = aprovados = recusados = 0
+    primeiro = None
+    for indice, frame in enumerate(ler_frames(origem)):
+        inicio = time.perf_counter()
+        result = leitor.processar_frame(frame)
+        latencias.append(time.perf_counter() - inicio)
+
+        if result['qr_data'] is not None:
+            lidos += 1
+            if primeiro is None:
+                primeiro = {'quadro': indice, 'ms': 1000 * sum(latencias)}
+        aprovados += result['success']
+        recusados += result['error']
+
+    if not latencias:
+        print(f"Nenhum frame lido de {origem}")
+        return None
+
+    ms = 1000 * np.array(latencias)
+    return {
+        'quadros': len(latencias),
+        'quadros_por_segundo': len(latencias) / sum(latencias),
+        'latencia_ms': {'p50': np.percentile(ms, 50), 'p90': np.percentile(ms, 90),
+                        'p99': np.percentile(ms, 99), 'max': ms.max()},
+        'primeiro_codigo': primeiro,
+        'quadros_com_codigo': lidos,
+        'taxa_leitura': lidos / len(latencias),
+        'aprovados': aprovados,
+        'recusados': recusados,
+        'decodificadores': leitor.pipeline.decodificadores.estatisticas(),
+    }
+
+
+def imprimir(metricas):
+    latencia = metricas['latencia_ms']
+    primeiro = metricas['primeiro_codigo']
+    print(f"quadros: {metricas['quadros']}, {metricas['quadros_por_segundo']:.1f} quadros/s")
+    print(f"latência: p50 {latencia['p50']:.1f} ms, p90 {latencia['p90']:.1f} ms, "
+          f"p99 {latencia['p99']:.1f} ms, máx {latencia['max']:.1f} ms")
+    if primeiro:
+        print(f"primeiro código: quadro {primeiro['quadro']}, após {primeiro['ms']:.1f} ms de processamento")
+    else:
+        print("primeiro código: nenhum")
+    print(f"leitura: {metricas['quadros_com_codigo']} quadros ({100 * metricas['taxa_leitura']:.1f}%), "
+          f"{metricas['aprovados']} aprovados, {metricas['recusados']} recusados")
+    for nome, m in metricas['decodificadores'].items():
+        print(f"  {nome}: {m['tentativas']} tentativas, {100 * m['taxa_acerto']:.1f}% lidos, "
+              f"{m['latencia_media_ms']:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mede o leitor do quiosque com um vídeo ou uma pasta de imagens")
+    parser.add_argument('origem', help="arquivo de vídeo ou pasta com imagens (.png, .jpg, .bmp)")
+    parser.add_argument('--decodificadores', help="ordem dos backends, ex.: zbar,opencv "
+                                                  "(padrão: BIBLIOTECA_QR_DECODIFICADORES)")
+    parser.add_argument('--processar', action='store_true',
+                        help="usa o QRCodeProcessor de verdade (altera o armazenamento configurado)")
+    parser.add_argument('--json', action='store_true', help="imprime as métricas em JSON")
+    args = parser.parse_args()
+
+    metricas = executar(args.origem, args.processar, args.decodificadores)
+    if metricas is None:
+        raise SystemExit(1)
+    if args.json:
+        print(json.dumps(metricas, default=float, indent=2))
+    else:
+        imprimir(metricas)
@@ -0,0 +1,301 @@
+from models import QRCodeData
+from urllib.parse import urlsplit
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import queue
+import ssl
+import threading
+import time
+
+# Mesmo limite de /api/process_qr/batch (MAX_LOTE_QR em app.py)
+MAX_LOTE = 500
+
+# Assinatura do corpo das requisições com o segredo compartilhado com o servidor
+CABECALHO_ASSINATURA = 'X-Quiosque-Assinatura'
+
+
+def assinar(segredo, corpo):
+    """HMAC-SHA256 (hex) do corpo da requisição, conferido pelo app.py"""
+    return hmac.new(segredo.encode(), corpo, hashlib.sha256).hexdigest()
+
+
+class ErroDeConfiguracao(Exception):
+    """O servidor respondeu, mas não como a API da biblioteca (URL, proxy ou
+    certificado errados); esperar não resolve, então a leitura não vai para a fila"""
+
+
+class PoolHTTP:
+    """Conexões HTTP/1.1 keep-alive com o servidor, reaproveitadas entre as
+    requisições, todas com o mesmo timeout.
+
+    Só erros de socket (recusa, timeout, conexão caída) chegam como OSError e
+    significam servidor fora do ar; respostas que não são da API viram
+    ErroDeConfiguracao.
+    """
+
+    def __init__(self, url, tamanho=2, timeout=5, segredo=None):
+        self.url = url
+        self.segredo = segredo
+        partes = urlsplit(url)
+        self.classe = http.client.HTTPSConnection if partes.scheme == 'https' else http.client.HTTPConnection
+        self.host = partes.hostname
+        self.porta = partes.port
+        self.prefixo = partes.path.rstrip('/')
+        self.timeout = timeout
+        self._livres = queue.LifoQueue(maxsize=tamanho)
+
+    def post_json(self, caminho, corpo):
+        """Devolve (status HTTP, JSON da resposta); uma resposta 5xx sem JSON
+        (proxy sem o servidor por trás) vem com o JSON vazio"""
+        corpo = json.dumps(corpo).encode()
+        cabecalhos = {'Content-Type': 'application/json'}
+        if self.segredo:
+            cabecalhos[CABECALHO_ASSINATURA] = assinar(self.segredo, corpo)
+
+        try:
+            conexao, reaproveitada = self._livres.get_nowait(), True
+        except queue.Empty:
+            conexao, reaproveitada = self.classe(self.host, self.porta, timeout=self.timeout), False
+
+        try:
+            try:
+                resposta = self._enviar(conexao, caminho, corpo, cabecalhos)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reaproveitada:
+                    raise
+                # O servidor fechou a conexão ociosa: tenta uma vez com uma nova
+                conexao = self.classe(self.host, self.porta, timeout=self.timeout)
+                resposta = self._enviar(conexao, caminho, corpo, cabecalhos)
+        except ssl.SSLCertVerificationError as e:
+            raise ErroDeConfiguracao(f"Certificado de {self.url} recusado: {str(e)}")
+        except http.client.HTTPException as e:
+            if isinstance(e, OSError):
+                raise
+            raise ErroDeConfiguracao(f"Resposta inválida de {self.url}: {e!r}")
+
+        status, dados, fechar = resposta
+        if fechar:
+            conexao.close()
+        else:
+            try:
+                self._livres.put_nowait(conexao)
+            except queue.Full:
+                conexao.close()
+
+        try:
+            return status, json.loads(dados) if dados else {}
+        except ValueError:
+            if status >= 500:
+                return status, {}
+            raise ErroDeConfiguracao(f"{self.url}{caminho} não respondeu como a API da biblioteca (HTTP {status})")
+
+    def _enviar(self, conexao, caminho, corpo, cabecalhos):
+        try:
+            conexao.request('POST', self.prefixo + caminho, body=corpo, headers=cabecalhos)
+            resposta = conexao.getresponse()
+            return resposta.status, resposta.read(), resposta.will_close
+        except Exception:
+            conexao.close()
+            raise
+
+    def fechar(self):
+        while True:
+            try:
+                self._livres.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class FilaOffline:
+    """Leituras feitas sem conexão com o servidor, na ordem em que ocorreram.
+
+    Cada leitura é acrescentada (com fsync) a um arquivo JSON lines antes de
+    ser confirmada ao usuário, então a fila sobrevive a quedas do quiosque.
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self._leituras = []
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+        self._carregar()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._leituras)
+
+    def contem(self, qr_data_str):
+        with self._lock:
+            return any(leitura['qr_data'] == qr_data_str for leitura in self._leituras)
+
+    def adicionar(self, qr_data_str, lido_em):
+        leitura = {'qr_data': qr_data_str, 'lido_em': lido_em}
+        with self._lock:
+            try:
+                with open(self.caminho, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(leitura) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                print(f"Erro ao gravar {self.caminho}: {str(e)}")
+                return False
+            self._leituras.append(leitura)
+            return True
+
+    def primeiras(self, quantidade):
+        with self._lock:
+            return list(self._leituras[:quantidade])
+
+    def remover(self, quantidade):
+        """Tira as primeiras leituras (já enviadas) e reescreve o arquivo com o resto"""
+        with self._lock:
+            restantes = self._leituras[quantidade:]
+            temporario = self.caminho + '.tmp'
+            try:
+                with open(temporario, 'w', encoding='utf-8') as f:
+                    f.writelines(json.dumps(leitura) + '\n' for leitura in restantes)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporario, self.caminho)
+            except OSError as e:
+                print(f"Erro ao gravar {self.caminho}: {str(e)}")
+                return False
+            self._leituras = restantes
+            return True
+
+    def _carregar(self):
+        if not os.path.exists(self.caminho):
+            return
+        with open(self.caminho, 'r', encoding='utf-8') as f:
+            for linha in f:
+                try:
+                    self._leituras.append(json.loads(linha))
+                except ValueError:
+                    # Última linha incompleta de uma gravação interrompida
+                    continue
+
+
+class ProcessadorRemoto:
+    """Substitui o QRCodeProcessor no quiosque: envia cada leitura para
+    /api/process_qr do servidor em vez de alterar o armazenamento local.
+
+    Sem servidor, a leitura é recusada: ninguém conferiu o estado do empréstimo
+    ou da doação, então a porta não abre e nada é registrado. Com o acesso
+    otimista ligado, a leitura é conferida localmente (assinatura e validade),
+    libera a porta e vai para a FilaOffline, enviada depois, em lotes, para
+    /api/process_qr/batch, sempre antes de qualquer leitura nova para manter a
+    ordem. A hora de cada leitura só é aceita pelo servidor com o segredo compartilhado.
+    """
+
+    def __init__(self, url, caminho_fila, timeout=5, intervalo=10, segredo=None, otimista=False):
+        self.pool = PoolHTTP(url, timeout=timeout, segredo=segredo)
+        self.fila = FilaOffline(caminho_fila)
+        self.intervalo = intervalo
+        self.otimista = otimista
+        self.validade = int(os.environ.get('BIBLIOTECA_QR_VALIDADE', 900))
+        self._lock = threading.Lock()
+        self._offline_ate = 0
+        self._parar = threading.Event()
+        threading.Thread(target=self._reenviar, daemon=True).start()
+
+    @classmethod
+    def do_ambiente(cls):
+        """Configurado por BIBLIOTECA_SERVIDOR; None se o quiosque usa o armazenamento local"""
+        url = os.environ.get('BIBLIOTECA_SERVIDOR')
+        if not url:
+            return None
+        segredo = os.environ.get('BIBLIOTECA_QUIOSQUE_SEGREDO') or None
+        otimista = os.environ.get('BIBLIOTECA_QUIOSQUE_OFFLINE_OTIMISTA', '').lower() in ('1', 'true', 'sim')
+        if otimista and not segredo:
+            print("BIBLIOTECA_QUIOSQUE_SEGREDO não definido: o servidor usará a hora do envio das leituras offline")
+        return cls(url,
+                   os.environ.get('BIBLIOTECA_FILA_OFFLINE', 'data/fila_quiosque.jsonl'),
+                   timeout=float(os.environ.get('BIBLIOTECA_SERVIDOR_TIMEOUT', 5)),
+                   segredo=segredo,
+                   otimista=otimista)
+
+    def process(self, qr_data_str):
+        with self._lock:
+            try:
+                return self._processar(qr_data_str)
+            except ErroDeConfiguracao as e:
+                print(f"Erro de configuração do quiosque: {str(e)}")
+                return False, "Quiosque mal configurado, avise a equipe da biblioteca"
+
+    def _processar(self, qr_data_str):
+        # Enquanto o servidor está fora, nem tenta: cada tentativa custaria um timeout
+        if time.time() < self._offline_ate or (len(self.fila) and not self._enviar_fila()):
+            return self._guardar_offline(qr_data_str)
+        try:
+            status, corpo = self.pool.post_json('/api/process_qr', {'qr_data': qr_data_str})
+        except OSError as e:
+            print(f"Servidor indisponível: {str(e)}")
+            self._offline_ate = time.time() + self.intervalo
+            return self._guardar_offline(qr_data_str)
+        if status >= 500:
+            self._offline_ate = time.time() + self.intervalo
+            return self._guardar_offline(qr_data_str)
+        return bool(corpo.get('success')), corpo.get('message', f"Erro no servidor (HTTP {status})")
+
+    def _guardar_offline(self, qr_data_str):
+        # Só vale o que de fato aconteceu na porta: sem acesso otimista ela não
+        # abriu, e a leitura não pode ser aplicada depois pelo servidor
+        if not self.otimista:
+            return False, "Sem conexão com o servidor, tente novamente em instantes"
+        qr_data = QRCodeData.deserialize(qr_data_str.strip())
+        if not qr_data:
+            return False, "QR Code inválido ou corrompido"
+        if qr_data.expirado(self.validade):
+            return False, "QR Code expirado, gere um novo"
+        if self.fila.contem(qr_data_str):
+            return False, "Leitura já registrada; aguardando o servidor"
+        if not self.fila.adicionar(qr_data_str, time.time()):
+            return False, "Servidor indisponível"
+        return True, "Sem conexão com o servidor: leitura registrada e será processada quando ele voltar"
+
+    def _enviar_fila(self):
+        """Envia as leituras offline em lotes, na ordem; False se o servidor não
+        respondeu. ErroDeConfiguracao é repassado e a fila fica como está"""
+        while len(self.fila):
+            lote = self.fila.primeiras(MAX_LOTE)
+            corpo = {'qr_data': [l['qr_data'] for l in lote], 'lidos_em': [l['lido_em'] for l in lote]}
+            try:
+                status, resposta = self.pool.post_json('/api/process_qr/batch', corpo)
+            except OSError as e:
+                print(f"Servidor indisponível: {str(e)}")
+                self._offline_ate = time.time() + self.intervalo
+                return False
+            if status >= 500:
+                self._offline_ate = time.time() + self.intervalo
+                return False
+
+            if status == 200:
+                for leitura, resultado in zip(lote, resposta.get('resultados', [])):
+                    if not resultado['success']:
+                        print(f"Leitura offline recusada pelo servidor ({leitura['qr_data']}): {resultado['message']}")
+            else:
+                # Lote que o servidor nunca vai aceitar: não pode travar a fila
+                print(f"Lote de {len(lote)} leituras offline descartado: HTTP {status} {resposta.get('message')}")
+            if not self.fila.remover(len(lote)):
+                return False
+        self._offline_ate = 0
+        return True
+
+    def _reenviar(self):
+        """Thread que esvazia a fila mesmo quando não há leituras novas"""
+        while not self._parar.wait(self.intervalo):
+            with self._lock:
+                try:
+                    if len(self.fila):
+                        self._enviar_fila()
+                except ErroDeConfiguracao as e:
+                    print(f"Erro de configuração do quiosque: {str(e)}")
+
+    def fechar(self):
+        self._parar.set()
+        self.pool.fechar()
@@ -18,7 +18,7 @@ def reset_database():
 
     # Adiciona créditos
     credit_system = CreditSystem()
-    credit_system.adicionar_creditos(admin.id, 10)
+    credit_system.adicionar_creditos(admin.id, 10, motivo='cadastro')
 
     print("=" * 50)
     print("Banco de dados reinicializado com sucesso!")
@@ -0,0 +1,320 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from utils import QRCodeProcessor
+
+try:
+    from pyzbar import pyzbar
+except ImportError:  # pacote ou biblioteca libzbar ausente
+    pyzbar = None
+
+
+class DecodificadorQR(ABC):
+    """Backend de decodificação: recebe uma imagem em tons de cinza e devolve
+    (textos, pontos), com os pontos do contorno dos códigos lidos na imagem"""
+    nome = None
+
+    @abstractmethod
+    def decodificar(self, imagem):
+        pass
+
+
+class DecodificadorOpenCV(DecodificadorQR):
+    nome = 'opencv'
+
+    def __init__(self, detector=None):
+        self.detector = detector or cv2.QRCodeDetector()
+
+    def decodificar(self, imagem):
+        retval, decoded_info, pontos, _ = self.detector.detectAndDecodeMulti(imagem)
+        if not retval:
+            return [], None
+        lidos = [(texto, cantos) for texto, cantos in zip(decoded_info, pontos) if texto]
+        return [texto for texto, _ in lidos], np.array([cantos for _, cantos in lidos])
+
+
+class DecodificadorZbar(DecodificadorQR):
+    nome = 'zbar'
+
+    def decodificar(self, imagem):
+        lidos = pyzbar.decode(imagem, symbols=[pyzbar.ZBarSymbol.QRCODE])
+        textos = [codigo.data.decode('utf-8', errors='replace') for codigo in lidos]
+        pontos = np.array([(p.x, p.y) for codigo in lidos for p in codigo.polygon], dtype=np.float32)
+        return textos, pontos.reshape(-1, 2)
+
+
+class CascataDecodificadores:
+    """Tenta os backends na ordem configurada até um deles ler o código e mede,
+    por backend, a latência e a taxa de acerto (para escolher o melhor para a câmera)"""
+
+    DECODIFICADORES = {'opencv': DecodificadorOpenCV, 'zbar': DecodificadorZbar}
+
+    def __init__(self, decodificadores):
+        self.decodificadores = list(decodificadores)
+        self._lock = threading.Lock()
+        self._medidas = {d.nome: {'tentativas': 0, 'acertos': 0, 'segundos': 0.0} for d in self.decodificadores}
+
+    @classmethod
+    def configurada(cls, detector=None, ordem=None):
+        """Backends na ordem de BIBLIOTECA_QR_DECODIFICADORES (ex.: "zbar,opencv")"""
+        ordem = ordem or os.environ.get('BIBLIOTECA_QR_DECODIFICADORES', 'opencv,zbar')
+        decodificadores = []
+        for nome in (n.strip().lower() for n in ordem.split(',') if n.strip()):
+            if nome not in cls.DECODIFICADORES:
+                print(f"Decodificador de QR Code desconhecido: {nome}")
+            elif nome == 'zbar' and pyzbar is None:
+                print("pyzbar/libzbar indisponível; decodificador zbar ignorado")
+            elif nome == 'opencv':
+                decodificadores.append(DecodificadorOpenCV(detector))
+            else:
+                decodificadores.append(cls.DECODIFICADORES[nome]())
+        # Sem nenhum backend válido o quiosque não leria nada: usa o OpenCV
+        return cls(decodificadores or [DecodificadorOpenCV(detector)])
+
+    def decodificar(self, imagem):
+        for decodificador in self.decodificadores:
+            inicio = time.perf_counter()
+            try:
+                textos, pontos = decodificador.decodificar(imagem)
+            except Exception as e:
+                print(f"Erro no decodificador {decodificador.nome}: {str(e)}")
+                textos, pontos = [], None
+            textos = [texto for texto in textos if texto]
+            with self._lock:
+                medida = self._medidas[decodificador.nome]
+                medida['tentativas'] += 1
+                medida['acertos'] += bool(textos)
+                medida['segundos'] += time.perf_counter() - inicio
+            if textos:
+                return textos, pontos
+        return [], None
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                nome: {
+                    'tentativas': m['tentativas'],
+                    'acertos': m['acertos'],
+                    'taxa_acerto': m['acertos'] / m['tentativas'] if m['tentativas'] else 0.0,
+                    'latencia_media_ms': 1000 * m['segundos'] / m['tentativas'] if m['tentativas'] else 0.0,
+                }
+                for nome, m in self._medidas.items()
+            }
+
+    def resumo(self):
+        return ', '.join(
+            f"{nome}: {m['tentativas']} tentativas, {100 * m['taxa_acerto']:.0f}% lidos, "
+            f"{m['latencia_media_ms']:.1f} ms"
+            for nome, m in self.estatisticas().items()
+        )
+
+
+class PipelineQR:
+    """Detecção e decodificação de QR Codes em estágios, do mais barato ao mais caro:
+
+    1. se há uma região (ROI) rastreada, decodifica só ela, em resolução cheia;
+    2. senão, procura o código no frame reduzido e, a cada poucos frames, também
+       na resolução cheia (ESCALAS), e passa a rastrear a região encontrada;
+    3. em cada região tenta primeiro o cinza puro e só então desfoque + Otsu,
+       cada imagem passando pela cascata de decodificadores configurada.
+
+    Depois de QUADROS_OCIOSO frames sem código, só um a cada SALTO_OCIOSO
+    frames é analisado, até que um código volte a aparecer.
+    """
+
+    # (escala, usada a cada n frames): a escala cheia pega códigos pequenos, mas custa o dobro
+    ESCALAS = ((0.5, 1), (1.0, 3))
+    MARGEM = 0.2
+    QUADROS_OCIOSO = 30
+    SALTO_OCIOSO = 3
+
+    def __init__(self, detector, decodificadores=None):
+        self.detector = detector
+        self.decodificadores = decodificadores or CascataDecodificadores.configurada(detector)
+        self.roi = None
+        self.quadros_sem_qr = 0
+        self._quadro = 0
+
+    def decodificar(self, frame):
+        """Textos dos QR Codes encontrados no frame (lista vazia se nenhum)"""
+        self._quadro += 1
+        if self.quadros_sem_qr >= self.QUADROS_OCIOSO and self._quadro % self.SALTO_OCIOSO:
+            return []
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.roi is not None:
+            textos = self._decodificar_regiao(gray, self.roi)
+            if textos:
+                return textos
+            self.roi = None
+
+        for escala, intervalo in self.ESCALAS:
+            if self._quadro % intervalo:
+                continue
+            reduzido = gray if escala == 1.0 else cv2.resize(gray, None, fx=escala, fy=escala,
+                                                            interpolation=cv2.INTER_AREA)
+            encontrou, pontos = self.detector.detectMulti(reduzido)
+            if encontrou:
+                self.roi = self._regiao(pontos / escala, gray.shape)
+                textos = self._decodificar_regiao(gray, self.roi)
+                if textos:
+                    return textos
+                # Código visto mas ainda ilegível: a região segue rastreada no próximo frame
+                break
+
+        self.quadros_sem_qr += 1
+        return []
+
+    def _decodificar_regiao(self, gray, roi):
+        x, y, w, h = roi
+        if min(w, h) < 21:  # menor que um QR Code versão 1
+            return []
+        recorte = gray[y:y + h, x:x + w]
+        for imagem in (recorte, None):
+            if imagem is None:
+                blur = cv2.GaussianBlur(recorte, (5, 5), 0)
+                _, imagem = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            textos, pontos = self.decodificadores.decodificar(imagem)
+            if textos:
+                # Reenquadra a região no código decodificado para o próximo frame
+                self.roi = self._regiao(pontos + (x, y), gray.shape)
+                self.quadros_sem_qr = 0
+                return textos
+        return []
+
+    def _regiao(self, pontos, forma):
+        """Retângulo que cobre os pontos, com margem, limitado ao frame"""
+        pontos = np.asarray(pontos).reshape(-1, 2)
+        x0, y0 = pontos.min(axis=0)
+        x1, y1 = pontos.max(axis=0)
+        margem = self.MARGEM * max(x1 - x0, y1 - y0)
+        altura, largura = forma[:2]
+        x0, y0 = max(int(x0 - margem), 0), max(int(y0 - margem), 0)
+        x1, y1 = min(int(x1 + margem), largura), min(int(y1 + margem), altura)
+        return x0, y0, x1 - x0, y1 - y0
+
+
+class LeiturasRecentes:
+    """Resultados dos últimos QR Codes processados pelo quiosque, para não chamar
+    o QRCodeProcessor de novo enquanto o mesmo código segue na frente da câmera.
+
+    Cada resultado, aprovado ou recusado, vale por `janela` segundos contados do
+    processamento (BIBLIOTECA_QR_DEBOUNCE, padrão 5).
+    """
+
+    def __init__(self, janela=None, max_itens=64):
+        self.janela = janela if janela is not None else float(os.environ.get('BIBLIOTECA_QR_DEBOUNCE', 5))
+        self.max_itens = max_itens
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, payload, agora):
+        """(success, message) de uma leitura ainda dentro da janela, ou None"""
+        with self._lock:
+            item = self._itens.get(payload)
+            if item is None:
+                return None
+            expira, resultado = item
+            if expira < agora:
+                del self._itens[payload]
+                return None
+            return resultado
+
+    def registrar(self, payload, success, message, agora):
+        with self._lock:
+            self._itens[payload] = (agora + self.janela, (success, message))
+            self._itens.move_to_end(payload)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+
+class LeitorQR:
+    """Leitura de QR Codes sem interface gráfica: pipeline de decodificação,
+    debounce e QRCodeProcessor. O quiosque (qr_interface.py) e o
+    benchmark_quiosque.py usam o mesmo processar_frame.
+    """
+
+    def __init__(self, qr_processor=None, debug=False, ordem_decodificadores=None):
+        self.debug = debug
+        self.detector = cv2.QRCodeDetector()
+        self.pipeline = PipelineQR(self.detector,
+                                   CascataDecodificadores.configurada(self.detector, ordem_decodificadores))
+        self.qr_processor = qr_processor or QRCodeProcessor.instance()
+        self.leituras_recentes = LeiturasRecentes()
+
+    def processar_frame(self, frame):
+        result = {
+            'frame': frame,
+            'success': False,
+            'error': False,
+            'message': "Posicione o QR Code",
+            'qr_data': None
+        }
+
+        try:
+            current_time = time.time()
+            decoded_info = self.pipeline.decodificar(frame)
+
+            if decoded_info:
+                processed_result = self._process_qr_codes(decoded_info, current_time, frame)
+                if processed_result:
+                    return processed_result
+
+            return result
+
+        except Exception as e:
+            result['error'] = True
+            result['message'] = f"Erro no processamento: {str(e)}"
+            return result
+
+    def _process_qr_codes(self, decoded_info, current_time, frame):
+        if not decoded_info:
+            return None
+
+        qr_data_str = decoded_info[0] if isinstance(decoded_info, (tuple, list)) else str(decoded_info)
+        qr_data_str = qr_data_str.strip("('").strip("',)")
+
+        anterior = self.leituras_recentes.obter(qr_data_str, current_time)
+        if anterior is None:
+            success, message = self.qr_processor.process(qr_data_str)
+            self.leituras_recentes.registrar(qr_data_str, success, message, current_time)
+        else:
+            success, message = anterior
+            if success:
+                # Já aprovado: não processa de novo nem reabre a porta
+                return {
+                    'frame': frame,
+                    'success': False,
+                    'message': "Aprovado - Aguardando ação",
+                    'error': False,
+                    'qr_data': qr_data_str
+                }
+
+        if success:
+            return {
+                'frame': self._draw_debug_info(frame, qr_data_str, "VALIDO"),
+                'success': True,
+                'message': message,
+                'error': False,
+                'qr_data': qr_data_str
+            }
+        else:
+            return {
+                'frame': self._draw_debug_info(frame, qr_data_str, "INVALIDO"),
+                'success': False,
+                'message': message,
+                'error': True,
+                'qr_data': qr_data_str
+            }
+
+    def _draw_debug_info(self, frame, qr_data, status):
+        if self.debug:
+            frame = cv2.putText(frame, f"STATUS: {status}", (10, 30),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+            frame = cv2.putText(frame, f"DATA: {qr_data[:30]}...", (10, 60),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+        return frame
@@ -0,0 +1,52 @@
+from utils import CSVManager, SQLITE_PATH_PADRAO
+from sqlite_engine import SQLiteEngine
+import argparse
+import csv
+import glob
+import os
+
+
+def ler_transacoes():
+    """Lê transacoes.csv e os segmentos já rotacionados (transacoes-<dia>.csv)"""
+    arquivos = glob.glob('data/transacoes-*.csv') + ['data/transacoes.csv']
+    linhas = []
+    for arquivo in arquivos:
+        if not os.path.exists(arquivo):
+            continue
+        with open(arquivo, 'r', newline='', encoding='utf-8') as f:
+            linhas.extend(csv.DictReader(f))
+    return sorted(linhas, key=lambda row: row.get('data') or '')
+
+
+def migrar(caminho=SQLITE_PATH_PADRAO, substituir=False):
+    engine = SQLiteEngine(caminho)
+
+    ocupadas = [tabela for tabela in CSVManager.HEADERS if engine.contar(tabela)]
+    if ocupadas and not substituir:
+        print(f"O banco {caminho} já possui dados em: {', '.join(ocupadas)}")
+        print("Use --substituir para sobrescrevê-los")
+        return False
+
+    for tabela in CSVManager.HEADERS:
+        if tabela == 'transacoes':
+            linhas = ler_transacoes()
+        else:
+            linhas = CSVManager.safe_read(f"{tabela}.csv")
+
+        if not engine.importar(tabela, linhas, substituir=substituir):
+            return False
+        print(f"{tabela}: {len(linhas)} registros importados")
+
+    print("=" * 50)
+    print(f"Migração concluída: {caminho}")
+    print("Inicie a aplicação com BIBLIOTECA_ENGINE=sqlite para usar o novo banco")
+    print("=" * 50)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Importa os CSVs de data/ para um banco SQLite")
+    parser.add_argument('caminho', nargs='?', default=SQLITE_PATH_PADRAO)
+    parser.add_argument('--substituir', action='store_true', help="apaga os dados já existentes no banco")
+    args = parser.parse_args()
+    migrar(args.caminho, args.substituir)
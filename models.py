@@ -4,6 +4,9 @@ from datetime import datetime
 from enum import Enum, auto
 import time
 import hashlib
+import hmac
+import base64
+import struct
 
 class UserType(Enum):
     NORMAL = 'normal'
@@ -19,10 +22,20 @@ class Usuario:
     tipo: UserType = UserType.NORMAL
 
     @classmethod
-    def criar_usuario(cls, email, senha, tipo=UserType.NORMAL):
-        salt = bcrypt.gensalt()
-        senha_hash = bcrypt.hashpw(senha.encode('utf-8'), salt)
-        return cls(id=0, email=email, senha_hash=senha_hash.decode('utf-8'), tipo=tipo)
+    def criar_usuario(cls, email, senha, tipo=UserType.NORMAL, custo=12):
+        return cls(id=0, email=email, senha_hash=cls.gerar_hash(senha, custo), tipo=tipo)
+
+    @staticmethod
+    def gerar_hash(senha, custo=12):
+        salt = bcrypt.gensalt(rounds=custo)
+        return bcrypt.hashpw(senha.encode('utf-8'), salt).decode('utf-8')
+
+    def custo_do_hash(self):
+        # Formato $2b$<custo>$<salt+hash>
+        try:
+            return int(self.senha_hash.split('$')[2])
+        except (IndexError, ValueError):
+            return None
 
     def verificar_senha(self, senha):
         try:
@@ -101,19 +114,62 @@ class QRCodeType(Enum):
 class QRCodeData:
     SECRET_KEY = "bibliocomunitaria_secret_123"
 
+    # Formato compacto: "1" + base32(tipo, object_id, user_id, timestamp inteiro
+    # e HMAC-SHA256 truncado). Só usa caracteres do modo alfanumérico do QR, o
+    # que diminui a versão do código gerado. O formato texto ainda é aceito.
+    VERSAO_COMPACTA = '1'
+    CAMPOS_COMPACTOS = struct.Struct('>BIII')
+    TAMANHO_HMAC = 8
+
     def __init__(self, qr_type: QRCodeType, object_id: int, user_id: int, timestamp: float = None):
         self.qr_type = qr_type
         self.object_id = object_id
         self.user_id = user_id
         self.timestamp = timestamp or time.time()
 
-    def serialize(self) -> str:
+    def serialize(self, compacto=True) -> str:
+        if compacto:
+            corpo = self.CAMPOS_COMPACTOS.pack(self.qr_type.value, self.object_id, self.user_id, int(self.timestamp))
+            return self.VERSAO_COMPACTA + base64.b32encode(corpo + self._assinar(corpo)).decode('ascii').rstrip('=')
+
         base_str = f"{self.qr_type.name}:{self.object_id}:{self.user_id}:{self.timestamp}"
         security_hash = hashlib.sha256(f"{base_str}{self.SECRET_KEY}".encode()).hexdigest()[:8]
         return f"{base_str}:{security_hash}"
 
+    def chave(self):
+        """Identifica o token, qualquer que seja o formato em que foi lido"""
+        return (self.qr_type.name, self.object_id, self.user_id, self.timestamp)
+
+    def expirado(self, validade, agora=None, tolerancia=60):
+        """Fora do intervalo [agora - validade, agora + tolerancia] (relógios dessincronizados)"""
+        agora = agora or time.time()
+        return not (agora - validade <= self.timestamp <= agora + tolerancia)
+
+    @classmethod
+    def _assinar(cls, corpo: bytes) -> bytes:
+        return hmac.new(cls.SECRET_KEY.encode(), corpo, hashlib.sha256).digest()[:cls.TAMANHO_HMAC]
+
+    @classmethod
+    def _deserialize_compacto(cls, qr_str: str):
+        try:
+            codificado = qr_str[len(cls.VERSAO_COMPACTA):]
+            dados = base64.b32decode(codificado + '=' * (-len(codificado) % 8))
+            if len(dados) != cls.CAMPOS_COMPACTOS.size + cls.TAMANHO_HMAC:
+                return None
+
+            corpo, assinatura = dados[:cls.CAMPOS_COMPACTOS.size], dados[cls.CAMPOS_COMPACTOS.size:]
+            if not hmac.compare_digest(assinatura, cls._assinar(corpo)):
+                return None
+
+            tipo, object_id, user_id, timestamp = cls.CAMPOS_COMPACTOS.unpack(corpo)
+            return QRCodeData(QRCodeType(tipo), object_id, user_id, float(timestamp))
+        except (ValueError, struct.error):
+            return None
+
     @classmethod
     def deserialize(cls, qr_str: str):
+        if qr_str.startswith(cls.VERSAO_COMPACTA):
+            return cls._deserialize_compacto(qr_str)
         try:
             parts = qr_str.split(':')
             if len(parts) != 5:
@@ -3,9 +3,10 @@ from tkinter import ttk, messagebox, font
 from abc import ABC, abstractmethod
 import cv2
 from PIL import Image, ImageTk
-import time
-import numpy as np
-from utils import DatabaseSingleton, QRCodeProcessor
+import queue
+import threading
+from leitor_qr import LeitorQR
+from cliente_quiosque import ProcessadorRemoto
 from datetime import datetime
 
 
@@ -89,7 +90,7 @@ class TrancaStatus(ttk.Frame):
         self.after_id = None
 
 
-class QRReaderInterface:
+class QRReaderInterface(LeitorQR):
     def __init__(self, root):
         self.root = root
         self.state = IdleState()
@@ -98,12 +99,17 @@ class QRReaderInterface:
         self.current_image = None
         self.video_source = 0
         self.setup_ui()
-
-        self.debug = False
-        self.detector = cv2.QRCodeDetector()
-        self.qr_processor = QRCodeProcessor()
-        self.last_valid_code = None
-        self.cooldown_until = 0
+        # Com BIBLIOTECA_SERVIDOR, as leituras vão para a aplicação web em vez do armazenamento local
+        super().__init__(ProcessadorRemoto.do_ambiente())
+
+        # Captura e decodificação rodam em threads próprias; o loop do Tk só
+        # exibe o frame mais recente e aplica os resultados (via root.after)
+        self._parar = threading.Event()
+        self._decodificar = threading.Event()
+        self._captura = None
+        self._frame_lock = threading.Lock()
+        self._ultimo_frame = None
+        self._camera_falhou = False
 
     def setup_ui(self):
         self.root.title("Leitor QR - Biblioteca Comunitária")
@@ -221,13 +227,69 @@ class QRReaderInterface:
             self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
             self.state = ScanningState()
             self.state.update_interface(self)
+            self._iniciar_threads()
             self.update_frame()
         else:
             messagebox.showerror("Erro", "Não foi possível acessar a câmera")
 
+    def _iniciar_threads(self):
+        # Evento e fila novos a cada leitura: threads de uma leitura anterior apenas terminam
+        self._parar = threading.Event()
+        self._camera_falhou = False
+        with self._frame_lock:
+            self._ultimo_frame = None
+        frames = queue.Queue(maxsize=1)
+
+        self._captura = threading.Thread(target=self._capturar, args=(self.camera, frames, self._parar), daemon=True)
+        self._captura.start()
+        threading.Thread(target=self._decodificar_frames, args=(frames, self._parar), daemon=True).start()
+        self._decodificar.set()
+
+    def _capturar(self, camera, frames, parar):
+        """Thread de captura: é a única que lê e libera a câmera"""
+        while not parar.is_set():
+            ret, frame = camera.read()
+            if not ret:
+                self._camera_falhou = True
+                break
+
+            frame = cv2.resize(frame, (640, 480))
+            with self._frame_lock:
+                self._ultimo_frame = frame
+            # Fila de um só frame: o decodificador sempre pega o mais recente
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            frames.put_nowait(frame)
+        camera.release()
+
+    def _decodificar_frames(self, frames, parar):
+        """Thread de decodificação: detecção do QR Code e QRCodeProcessor"""
+        while not parar.is_set():
+            try:
+                frame = frames.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if not self._decodificar.is_set():
+                continue
+
+            result = self.processar_frame(frame)
+            if result['success'] or result['error']:
+                # Pausa até a interface voltar a ler (continue_scanning)
+                self._decodificar.clear()
+                self.root.after(0, self._aplicar_resultado, result)
+
     def parar_leitura(self):
-        if self.camera and self.camera.isOpened():
+        self._parar.set()
+        self._decodificar.clear()
+        if self._captura is not None:
+            # Espera a câmera ser liberada antes de uma nova abertura
+            self._captura.join(timeout=1)
+            self._captura = None
+        elif self.camera and self.camera.isOpened():
             self.camera.release()
+        print(f"Decodificadores de QR Code - {self.pipeline.decodificadores.resumo()}")
         self.state = IdleState()
         self.state.update_interface(self)
 
@@ -240,105 +302,47 @@ class QRReaderInterface:
         if isinstance(self.state, ErrorState):
             self.state = ScanningState()
             self.state.update_interface(self)
+            self.status_icon.config(text="⏺", foreground='#3498db')
+            self._decodificar.set()
             self.update_frame()
 
+    def _exibir(self, frame):
+        img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        self.current_image = ImageTk.PhotoImage(image=img)
+        self.video_frame.config(image=self.current_image)
+
     def update_frame(self):
+        """Pré-visualização: só exibe o último frame capturado, sem decodificar"""
         if not isinstance(self.state, ScanningState):
             return
 
-        ret, frame = self.camera.read()
-        if not ret:
+        if self._camera_falhou:
             self.root.after(1000, self.reiniciar_camera)
             return
 
-        frame = cv2.resize(frame, (640, 480))
-        result = self.processar_frame(frame)
+        with self._frame_lock:
+            frame = self._ultimo_frame
+        if frame is not None:
+            self._exibir(frame)
 
-        img = Image.fromarray(cv2.cvtColor(result['frame'], cv2.COLOR_BGR2RGB))
-        self.current_image = ImageTk.PhotoImage(image=img)
-        self.video_frame.config(image=self.current_image)
+        self.root.after(30, self.update_frame)
+
+    def _aplicar_resultado(self, result):
+        """Chamado no loop do Tk com o resultado da thread de decodificação"""
+        if not isinstance(self.state, ScanningState):
+            return
 
+        self._exibir(result['frame'])
         if result['success']:
+            self.tranca_status.abrir_porta()
             self.state = SuccessState(result['message'])
             self.status_icon.config(text="✓", foreground='#27ae60')
-        elif result['error']:
+        else:
             self.state = ErrorState(result['message'])
             self.status_icon.config(text="✗", foreground='#e74c3c')
-        else:
-            self.status_icon.config(text="⏺", foreground='#3498db')
 
         self.state.update_interface(self)
 
-        if isinstance(self.state, ScanningState):
-            self.root.after(30, self.update_frame)
-
-    def processar_frame(self, frame):
-        result = {
-            'frame': frame,
-            'success': False,
-            'error': False,
-            'message': "Posicione o QR Code"
-        }
-
-        try:
-            current_time = time.time()
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            blur = cv2.GaussianBlur(gray, (5, 5), 0)
-            _, thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-
-            retval, decoded_info, points, _ = self.detector.detectAndDecodeMulti(thresh)
-
-            if retval:
-                processed_result = self._process_qr_codes(decoded_info, current_time, frame)
-                if processed_result:
-                    return processed_result
-
-            if current_time < self.cooldown_until and self.last_valid_code:
-                result['message'] = "Aprovado - Aguardando ação"
-                return result
-
-            return result
-
-        except Exception as e:
-            result['error'] = True
-            result['message'] = f"Erro no processamento: {str(e)}"
-            return result
-
-    def _process_qr_codes(self, decoded_info, current_time, frame):
-        if not decoded_info:
-            return None
-
-        qr_data_str = decoded_info[0] if isinstance(decoded_info, (tuple, list)) else str(decoded_info)
-        qr_data_str = qr_data_str.strip("('").strip("',)")
-
-        success, message = self.qr_processor.process(qr_data_str)
-        if success:
-            self.tranca_status.abrir_porta()
-            self.last_valid_code = qr_data_str
-            self.cooldown_until = current_time + 5
-
-            return {
-                'frame': self._draw_debug_info(frame, qr_data_str, "VALIDO"),
-                'success': True,
-                'message': message,
-                'error': False
-            }
-        else:
-            return {
-                'frame': self._draw_debug_info(frame, qr_data_str, "INVALIDO"),
-                'success': False,
-                'message': message,
-                'error': True
-            }
-
-    def _draw_debug_info(self, frame, qr_data, status):
-        if self.debug:
-            frame = cv2.putText(frame, f"STATUS: {status}", (10, 30),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-            frame = cv2.putText(frame, f"DATA: {qr_data[:30]}...", (10, 60),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
-        return frame
-
     def reiniciar_camera(self):
         self.parar_leitura()
         self.iniciar_leitura()
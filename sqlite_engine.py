@@ -0,0 +1,303 @@
+import os
+import sqlite3
+import threading
+from utils import StorageEngine, CSVManager, Transacao
+
+# Colunas guardadas como INTEGER; as demais são TEXT, como nos CSVs
+COLUNAS_INTEIRAS = {'id', 'usuario_id', 'livro_id', 'doador_id', 'creditos', 'delta'}
+
+INDICES = [
+    "CREATE INDEX IF NOT EXISTS idx_usuarios_email ON usuarios(email)",
+    "CREATE INDEX IF NOT EXISTS idx_emprestimos_usuario_id ON emprestimos(usuario_id)",
+    "CREATE INDEX IF NOT EXISTS idx_emprestimos_livro_id ON emprestimos(livro_id)",
+    "CREATE INDEX IF NOT EXISTS idx_emprestimos_status ON emprestimos(status)",
+    "CREATE INDEX IF NOT EXISTS idx_doacoes_usuario_id ON doacoes(usuario_id)",
+    "CREATE INDEX IF NOT EXISTS idx_doacoes_status ON doacoes(status)",
+    "CREATE INDEX IF NOT EXISTS idx_creditos_usuario_id ON creditos(usuario_id)",
+]
+
+# Contador de alterações por tabela, mantido por triggers em qualquer conexão
+VERSOES = "CREATE TABLE IF NOT EXISTS versoes (tabela TEXT PRIMARY KEY, n INTEGER NOT NULL DEFAULT 0)"
+TRIGGER_VERSAO = (
+    "CREATE TRIGGER IF NOT EXISTS versao_{tabela}_{operacao} AFTER {operacao} ON {tabela} "
+    "BEGIN UPDATE versoes SET n = n + 1 WHERE tabela = '{tabela}'; END"
+)
+
+
+def _row_como_texto(cursor, row):
+    """Devolve as linhas no mesmo formato do csv.DictReader (tudo string)"""
+    return {col[0]: '' if valor is None else str(valor) for col, valor in zip(cursor.description, row)}
+
+
+class SQLiteEngine(StorageEngine):
+    """Armazenamento em SQLite no modo WAL, com as mesmas tabelas e colunas dos CSVs.
+
+    Uma única conexão por processo é compartilhada entre as threads e protegida
+    por um lock; as consultas são parametrizadas e reaproveitadas pelo cache de
+    statements preparados do sqlite3.
+    """
+
+    soma_indexada = True
+
+    def __init__(self, caminho):
+        super().__init__()
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+
+        self.caminho = caminho
+        self._lock = threading.RLock()
+        # Alterações feitas por esta conexão, descontadas em versao()
+        self._proprias = dict.fromkeys(CSVManager.HEADERS, 0)
+        self._conn = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None,
+                                     cached_statements=256)
+        self._conn.row_factory = _row_como_texto
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._criar_esquema()
+
+    def _criar_esquema(self):
+        with self._lock:
+            for tabela, colunas in CSVManager.HEADERS.items():
+                definicoes = []
+                for coluna in colunas:
+                    if coluna == 'id':
+                        definicoes.append('id INTEGER PRIMARY KEY')
+                    elif coluna in COLUNAS_INTEIRAS:
+                        definicoes.append(f'{coluna} INTEGER')
+                    else:
+                        definicoes.append(f'{coluna} TEXT')
+                self._conn.execute(f"CREATE TABLE IF NOT EXISTS {tabela} ({', '.join(definicoes)})")
+            for indice in INDICES:
+                self._conn.execute(indice)
+            self._conn.execute(VERSOES)
+            for tabela in CSVManager.HEADERS:
+                self._conn.execute("INSERT OR IGNORE INTO versoes (tabela, n) VALUES (?, 0)", (tabela,))
+                for operacao in ('INSERT', 'UPDATE', 'DELETE'):
+                    self._conn.execute(TRIGGER_VERSAO.format(tabela=tabela, operacao=operacao))
+
+    @staticmethod
+    def _colunas(tabela, campos=()):
+        if tabela not in CSVManager.HEADERS:
+            raise ValueError(f"Tabela desconhecida: {tabela}")
+        colunas = CSVManager.HEADERS[tabela]
+        for campo in campos:
+            if campo not in colunas:
+                raise ValueError(f"Coluna desconhecida em {tabela}: {campo}")
+        return colunas
+
+    @staticmethod
+    def _valor(coluna, valor):
+        if coluna in COLUNAS_INTEIRAS and valor in (None, ''):
+            return None
+        return valor
+
+    def versao(self, tabela):
+        # Só as alterações de outras conexões contam: as próprias já chegaram
+        # aos índices em memória pelos observadores
+        self._colunas(tabela)
+        with self._lock:
+            return self._contadores([tabela])[tabela] - self._proprias[tabela]
+
+    def _contadores(self, tabelas):
+        tabelas = list(tabelas)
+        rows = self._conn.execute(
+            f"SELECT tabela, n FROM versoes WHERE tabela IN ({', '.join('?' * len(tabelas))})", tabelas
+        ).fetchall()
+        return {row['tabela']: int(row['n']) for row in rows}
+
+    def _contar_proprias(self, antes, depois):
+        """Chamado após o COMMIT com os contadores lidos dentro da transação,
+        quando nenhuma outra conexão podia gravar"""
+        for tabela, n in depois.items():
+            self._proprias[tabela] += n - antes[tabela]
+
+    def get(self, tabela, campo, valor):
+        self._colunas(tabela, [campo])
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT * FROM {tabela} WHERE {campo} = ? ORDER BY id LIMIT 1", (valor,)
+            ).fetchone()
+
+    def get_many(self, tabela, ids):
+        self._colunas(tabela)
+        ids = list(ids)
+        encontrados = {}
+        with self._lock:
+            # Respeita o limite de parâmetros por consulta do SQLite
+            for inicio in range(0, len(ids), 500):
+                parte = ids[inicio:inicio + 500]
+                rows = self._conn.execute(
+                    f"SELECT * FROM {tabela} WHERE id IN ({', '.join('?' * len(parte))})", parte
+                ).fetchall()
+                por_id = {row['id']: row for row in rows}
+                for row_id in parte:
+                    if str(row_id) in por_id:
+                        encontrados[row_id] = por_id[str(row_id)]
+        return encontrados
+
+    def filtrar(self, tabela, campo, valor):
+        self._colunas(tabela, [campo])
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT * FROM {tabela} WHERE {campo} = ? ORDER BY id", (valor,)
+            ).fetchall()
+
+    def somar(self, tabela, campo, grupo, valor):
+        """SUM(campo) das linhas com grupo == valor, pelo índice de grupo"""
+        self._colunas(tabela, [campo, grupo])
+        with self._lock:
+            return int(self._conn.execute(
+                f"SELECT COALESCE(SUM({campo}), 0) AS soma FROM {tabela} WHERE {grupo} = ?", (valor,)
+            ).fetchone()['soma'])
+
+    def somar_por_grupo(self, tabela, campo, grupo):
+        """{valor do grupo: SUM(campo)} da tabela inteira em uma única consulta"""
+        self._colunas(tabela, [campo, grupo])
+        with self._lock:
+            return {int(row['grupo']): int(row['soma']) for row in self._conn.execute(
+                f"SELECT {grupo} AS grupo, SUM({campo}) AS soma FROM {tabela} GROUP BY {grupo}"
+            )}
+
+    def linhas(self, tabela):
+        self._colunas(tabela)
+        with self._lock:
+            return self._conn.execute(f"SELECT * FROM {tabela} ORDER BY id").fetchall()
+
+    def _inserir(self, tabela, row):
+        colunas = [c for c in self._colunas(tabela) if c != 'id' or row.get('id')]
+        sql = f"INSERT INTO {tabela} ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})"
+        return self._conn.execute(sql, [self._valor(c, row.get(c)) for c in colunas]).lastrowid
+
+    def _atualizar(self, tabela, row_id, campos, esperado):
+        self._colunas(tabela, list(campos) + list(esperado))
+        atribuicoes = ', '.join(f"{c} = ?" for c in campos)
+        condicoes = ''.join(f" AND {c} = ?" for c in esperado)
+        parametros = [self._valor(c, v) for c, v in campos.items()] + [row_id] + list(esperado.values())
+        cursor = self._conn.execute(f"UPDATE {tabela} SET {atribuicoes} WHERE id = ?{condicoes}", parametros)
+        return cursor.rowcount > 0
+
+    def inserir(self, tabela, row):
+        tx = Transacao(self)
+        row = tx.inserir(tabela, row)
+        return row['id'] if tx.commit() else None
+
+    def atualizar(self, tabela, row_id, campos, esperado=None):
+        tx = Transacao(self)
+        tx.atualizar(tabela, row_id, campos, esperado)
+        return tx.commit()
+
+    def commit(self, transacoes):
+        """Grava o lote em um único COMMIT; cada transação fica em um SAVEPOINT
+        próprio, então a falha de uma não desfaz as demais"""
+        resultados = []
+        tabelas = set().union(*(tx.tabelas() for tx in transacoes))
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                antes = self._contadores(tabelas)
+                for tx in transacoes:
+                    self._conn.execute("SAVEPOINT transacao")
+                    ok = self._executar(tx)
+                    if not ok:
+                        self._conn.execute("ROLLBACK TO transacao")
+                    self._conn.execute("RELEASE transacao")
+                    resultados.append(ok)
+                depois = self._contadores(tabelas)
+                self._conn.execute("COMMIT")
+            except Exception as e:
+                print(f"Erro no commit: {str(e)}")
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                return [False] * len(transacoes)
+
+            self._contar_proprias(antes, depois)
+            confirmadas = [tx for tx, ok in zip(transacoes, resultados) if ok]
+            self._notificar([self._como_texto(op) for tx in confirmadas for op in tx.operacoes
+                             if op['op'] != 'conferir'])
+            return resultados
+
+    def _executar(self, tx):
+        for op in tx.operacoes:
+            if op['op'] == 'inserir':
+                op['row']['id'] = self._inserir(op['tabela'], op['row'])
+                if op['soma_minima'] and not self._soma_valida(op):
+                    return False
+                if op['unico'] and not self._unico_valido(op):
+                    return False
+            elif op['op'] == 'conferir':
+                if not self._conferir(op['tabela'], op['id'], op['esperado']):
+                    return False
+            elif not self._atualizar(op['tabela'], op['id'], op['campos'], op['esperado']):
+                return False
+        return True
+
+    def _soma_valida(self, op):
+        """Conferida depois do INSERT, dentro do SAVEPOINT da transação"""
+        campo, grupo, minimo = op['soma_minima']
+        self._colunas(op['tabela'], [campo, grupo])
+        soma = self._conn.execute(
+            f"SELECT COALESCE(SUM({campo}), 0) AS soma FROM {op['tabela']} WHERE {grupo} = ?",
+            (op['row'][grupo],)
+        ).fetchone()['soma']
+        return int(soma) >= minimo
+
+    def _unico_valido(self, op):
+        grupo, campo, valores = op['unico']
+        tabela = op['tabela']
+        self._colunas(tabela, [grupo, campo])
+        conflito = self._conn.execute(
+            f"SELECT 1 FROM {tabela} WHERE {grupo} = ? AND id != ? "
+            f"AND {campo} IN ({', '.join('?' * len(valores))}) LIMIT 1",
+            [op['row'][grupo], op['row']['id'], *valores]
+        ).fetchone()
+        return conflito is None
+
+    def _conferir(self, tabela, row_id, esperado):
+        self._colunas(tabela, esperado)
+        condicoes = ''.join(f" AND {c} = ?" for c in esperado)
+        return self._conn.execute(
+            f"SELECT 1 FROM {tabela} WHERE id = ?{condicoes}", [row_id, *esperado.values()]
+        ).fetchone() is not None
+
+    @staticmethod
+    def _como_texto(op):
+        """Operação no mesmo formato que o CSVEngine passa aos observadores"""
+        def texto(valores):
+            return {c: '' if v is None else str(v) for c, v in valores.items()}
+
+        if op['op'] == 'inserir':
+            return {'op': 'inserir', 'tabela': op['tabela'], 'row': texto(op['row'])}
+        return {'op': 'atualizar', 'tabela': op['tabela'], 'id': op['id'], 'campos': texto(op['campos'])}
+
+    def registrar_transacoes(self, linhas, max_bytes=None):
+        return self.importar('transacoes', linhas)
+
+    def importar(self, tabela, linhas, substituir=False):
+        """Insere muitas linhas (mantendo os ids informados) em uma única transação"""
+        colunas = self._colunas(tabela)
+        sql = f"INSERT INTO {tabela} ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})"
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    antes = self._contadores([tabela])
+                    if substituir:
+                        self._conn.execute(f"DELETE FROM {tabela}")
+                    self._conn.executemany(sql, ([self._valor(c, row.get(c)) for c in colunas] for row in linhas))
+                    depois = self._contadores([tabela])
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                self._contar_proprias(antes, depois)
+            return True
+        except sqlite3.Error as e:
+            print(f"Erro ao importar {tabela}: {str(e)}")
+            return False
+
+    def contar(self, tabela):
+        self._colunas(tabela)
+        with self._lock:
+            return int(self._conn.execute(f"SELECT COUNT(*) AS total FROM {tabela}").fetchone()['total'])
@@ -0,0 +1,149 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from models import QRCodeData, QRCodeType
+from cliente_quiosque import CABECALHO_ASSINATURA, ProcessadorRemoto, assinar
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+SEGREDO = 'segredo-de-teste'
+
+
+class ServidorFalso:
+    """Servidor HTTP/1.1 no lugar do app.py: aprova toda leitura e guarda as
+    requisições recebidas"""
+
+    def __init__(self, porta=0, html=False):
+        self.requisicoes = []
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                dados = self.rfile.read(int(self.headers['Content-Length']))
+                servidor.requisicoes.append((self.path, dict(self.headers), dados))
+                if html:
+                    resposta, status, tipo = b'<html>Not Found</html>', 404, 'text/html'
+                elif self.path.endswith('/batch'):
+                    leituras = json.loads(dados)['qr_data']
+                    resposta = json.dumps({'success': True, 'resultados': [
+                        {'success': True, 'message': 'ok'} for _ in leituras]}).encode()
+                    status, tipo = 200, 'application/json'
+                else:
+                    resposta = json.dumps({'success': True, 'message': 'Empréstimo registrado'}).encode()
+                    status, tipo = 200, 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', tipo)
+                self.send_header('Content-Length', str(len(resposta)))
+                self.end_headers()
+                self.wfile.write(resposta)
+
+            def log_message(self, *args):
+                pass
+
+        ThreadingHTTPServer.allow_reuse_address = True
+        self.http = ThreadingHTTPServer(('127.0.0.1', porta), Handler)
+        self.porta = self.http.server_port
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    def parar(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+
+def qr_code(object_id):
+    return QRCodeData(QRCodeType.EMPRESTIMO, object_id, 1).serialize()
+
+
+class TestProcessadorRemoto(unittest.TestCase):
+
+    def setUp(self):
+        self.pasta = tempfile.TemporaryDirectory()
+        self.fila = os.path.join(self.pasta.name, 'fila.jsonl')
+        self.servidor = ServidorFalso()
+        self.processador = self.novo_processador(self.servidor.porta)
+
+    def tearDown(self):
+        self.processador.fechar()
+        if self.servidor:
+            self.servidor.parar()
+        self.pasta.cleanup()
+
+    def novo_processador(self, porta, **opcoes):
+        # Intervalo longo: a thread de reenvio não interfere no teste
+        return ProcessadorRemoto(f'http://127.0.0.1:{porta}', self.fila, timeout=2,
+                                 intervalo=3600, segredo=SEGREDO, **opcoes)
+
+    def test_leitura_online(self):
+        self.assertEqual(self.processador.process(qr_code(1)), (True, 'Empréstimo registrado'))
+        caminho, cabecalhos, corpo = self.servidor.requisicoes[-1]
+        self.assertEqual(caminho, '/api/process_qr')
+        self.assertEqual(json.loads(corpo), {'qr_data': qr_code(1)})
+        self.assertEqual(len(self.processador.fila), 0)
+
+    def derrubar_servidor(self):
+        porta = self.servidor.porta
+        self.servidor.parar()
+        self.servidor = None
+        return porta
+
+    def test_queda_recusa_sem_guardar_nada(self):
+        porta = self.derrubar_servidor()
+
+        success, message = self.processador.process(qr_code(1))
+        self.assertFalse(success)
+        self.assertIn('Sem conexão', message)
+        self.assertEqual(len(self.processador.fila), 0)
+        self.assertFalse(os.path.exists(self.fila))
+
+        # A leitura recusada não é enviada quando o servidor volta
+        self.servidor = ServidorFalso(porta)
+        self.processador._offline_ate = 0
+        self.assertEqual(self.processador.process(qr_code(2)), (True, 'Empréstimo registrado'))
+        self.assertEqual([json.loads(corpo) for _, _, corpo in self.servidor.requisicoes],
+                         [{'qr_data': qr_code(2)}])
+
+    def test_acesso_otimista_guarda_na_fila_e_envia_o_lote_depois(self):
+        self.processador.fechar()
+        self.processador = self.novo_processador(self.servidor.porta, otimista=True)
+        porta = self.derrubar_servidor()
+
+        success, message = self.processador.process(qr_code(1))
+        self.assertTrue(success)
+        self.assertIn('Sem conexão', message)
+        # Enquanto offline, nem tenta o servidor
+        self.assertTrue(self.processador.process(qr_code(2))[0])
+        self.assertFalse(self.processador.process(qr_code(2))[0])
+        self.assertEqual(len(self.processador.fila), 2)
+
+        self.servidor = ServidorFalso(porta)
+        self.processador._offline_ate = 0
+        self.assertEqual(self.processador.process(qr_code(3)), (True, 'Empréstimo registrado'))
+
+        (lote, cabecalhos, corpo), (online, _, _) = self.servidor.requisicoes
+        self.assertEqual(lote, '/api/process_qr/batch')
+        self.assertEqual(online, '/api/process_qr')
+        self.assertEqual(json.loads(corpo)['qr_data'], [qr_code(1), qr_code(2)])
+        self.assertEqual(cabecalhos[CABECALHO_ASSINATURA], assinar(SEGREDO, corpo))
+        self.assertEqual(len(self.processador.fila), 0)
+        self.assertFalse(os.path.getsize(self.fila))
+
+    def test_resposta_que_nao_e_da_api_nao_vai_para_a_fila(self):
+        self.processador.fechar()
+        self.servidor.parar()
+        self.servidor = ServidorFalso(html=True)
+        self.processador = self.novo_processador(self.servidor.porta)
+
+        success, message = self.processador.process(qr_code(1))
+        self.assertFalse(success)
+        self.assertIn('mal configurado', message)
+        self.assertEqual(len(self.processador.fila), 0)
+        # Não entrou em modo offline: a próxima leitura também vai ao servidor
+        self.processador.process(qr_code(2))
+        self.assertEqual(len(self.servidor.requisicoes), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
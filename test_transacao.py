@@ -0,0 +1,61 @@
+from utils import CSVEngine, Transacao
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        # O CSVEngine grava em data/ relativo ao diretório atual
+        self.anterior = os.getcwd()
+        self.pasta = tempfile.TemporaryDirectory()
+        os.chdir(self.pasta.name)
+        self.engine = CSVEngine()
+
+    def tearDown(self):
+        os.chdir(self.anterior)
+        self.pasta.cleanup()
+
+    def credito(self, delta):
+        tx = Transacao(self.engine)
+        tx.inserir('creditos', {'usuario_id': 1, 'delta': delta}, soma_minima=('delta', 'usuario_id', 0))
+        return tx
+
+    def commits_na_mesma_fila(self, transacoes):
+        """Enfileira as transações enquanto outro commit segura o lock, para que
+        sejam gravadas no mesmo lote"""
+        resultados = {}
+
+        def commit(tx):
+            try:
+                resultados[id(tx)] = tx.commit()
+            except Exception as e:
+                resultados[id(tx)] = e
+
+        threads = [threading.Thread(target=commit, args=(tx,)) for tx in transacoes]
+        with self.engine._commit_lock:
+            for thread in threads:
+                thread.start()
+            while len(self.engine._fila) < len(transacoes):
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join(5)
+        return [resultados.get(id(tx)) for tx in transacoes]
+
+    def test_transacao_invalida_falha_sozinha_no_lote(self):
+        resultados = self.commits_na_mesma_fila([self.credito('abc'), self.credito(5)])
+        self.assertEqual(resultados, [False, True])
+        self.assertEqual([row['delta'] for row in self.engine.linhas('creditos')], ['5'])
+
+    def test_tabela_desconhecida_falha_sozinha_no_lote(self):
+        desconhecida = Transacao(self.engine)
+        desconhecida.inserir('nao_existe', {'campo': 1})
+        resultados = self.commits_na_mesma_fila([desconhecida, self.credito(3)])
+        self.assertEqual(resultados, [False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
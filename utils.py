@@ -1,46 +1,78 @@
+import atexit
 import csv
+import glob
+import json
 import os
+import re
+import unicodedata
 from datetime import datetime
 import tempfile
+import threading
+import time
+from collections import OrderedDict
 from models import Usuario, Livro, Emprestimo, Doacao, UserType, QRCodeType, QRCodeData
 import qrcode
 from io import BytesIO
 from abc import ABC, abstractmethod
 from dataclasses import asdict
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: apenas locks entre threads
+    fcntl = None
+
+SQLITE_PATH_PADRAO = 'data/biblioteca.db'
+MENSAGEM_CONFLITO = "Operação não concluída: o registro foi alterado, leia o QR Code novamente"
 
 class QRCodeStrategy(ABC):
+    # Tabela do objeto referenciado pelo QR Code
+    tabela = None
+
+    def process(self, qr_data: QRCodeData):
+        tx = DatabaseSingleton.instance().transacao()
+        sucesso, mensagem = self.preparar(qr_data, tx)
+        if sucesso and not tx.commit():
+            return False, MENSAGEM_CONFLITO
+        return sucesso, mensagem
+
     @abstractmethod
-    def process(self, data):
-        pass
+    def preparar(self, qr_data, tx):
+        """Valida o QR Code e agenda as alterações em tx; devolve (sucesso, mensagem)"""
 
 class EmprestimoQRStrategy(QRCodeStrategy):
-    def process(self, qr_data: QRCodeData):
+    tabela = 'emprestimos'
+
+    def preparar(self, qr_data: QRCodeData, tx):
         db = DatabaseSingleton.instance()
         emprestimo = db.get_emprestimo_by_id(qr_data.object_id)
 
         if not emprestimo or emprestimo.usuario_id != qr_data.user_id:
             return False, "Empréstimo não encontrado"
 
-        if emprestimo.status == "pendente":
-            db.atualizar_status_emprestimo(emprestimo.id, "retirado")
+        if emprestimo.status == "pendente" and db.atualizar_status_emprestimo(emprestimo.id, "retirado", tx=tx):
             return True, "Livro retirado com sucesso"
         return False, "Status inválido para empréstimo"
 
 class DevolucaoQRStrategy(QRCodeStrategy):
-    def process(self, qr_data: QRCodeData):
+    tabela = 'emprestimos'
+
+    def preparar(self, qr_data: QRCodeData, tx):
         db = DatabaseSingleton.instance()
         emprestimo = db.get_emprestimo_by_id(qr_data.object_id)
 
         if not emprestimo or emprestimo.usuario_id != qr_data.user_id:
             return False, "Empréstimo não encontrado"
 
-        if emprestimo.status == "retirado":
-            db.atualizar_status_emprestimo(emprestimo.id, "devolvido")
+        if emprestimo.status == "retirado" and db.atualizar_status_emprestimo(emprestimo.id, "devolvido", tx=tx):
             return True, "Livro devolvido com sucesso"
         return False, "Status inválido para devolução"
 
 class DoacaoQRStrategy(QRCodeStrategy):
-    def process(self, qr_data: QRCodeData):
+    tabela = 'doacoes'
+
+    def preparar(self, qr_data: QRCodeData, tx):
         db = DatabaseSingleton.instance()
         doacao = db.get_doacao_by_id(qr_data.object_id)
 
@@ -58,15 +90,108 @@ class DoacaoQRStrategy(QRCodeStrategy):
                 aprovado=True
             )
 
-            if db.adicionar_livro(livro):
-                db.atualizar_status_doacao(doacao.id, "concluido")
-                CreditSystem().adicionar_creditos(doacao.usuario_id, 9)
+            # Livro, doação e créditos são gravados juntos
+            db.adicionar_livro(livro, tx=tx)
+            db.atualizar_status_doacao(doacao.id, "concluido", status_atual="aprovado", tx=tx)
+            if db.lancar_creditos(doacao.usuario_id, 9, 'doacao', tx=tx):
                 return True, "Doação concluída! +9 créditos"
         return False, "Doação não pode ser processada"
 
 
+class TokensUsados:
+    """QR Codes já consumidos, para recusar reutilizações sem ler o armazenamento.
+
+    LRU limitado a max_itens em que cada token vale por ttl segundos (depois
+    disso ele já está expirado). Com caminho, os tokens também são acrescentados
+    a um arquivo JSON lines e recarregados na inicialização. Vários processos
+    (workers do gunicorn, quiosque) usam o mesmo arquivo: os acréscimos são
+    feitos com <caminho>.lock compartilhado e a compactação com ele exclusivo.
+    """
+
+    def __init__(self, ttl, max_itens=10000, caminho=None):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self.caminho = caminho
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        if caminho:
+            self._trava = TableLock(None, filepath=f"{caminho}.lock")
+            self._carregar()
+
+    def contem(self, chave):
+        with self._lock:
+            expira = self._itens.get(chave)
+            if expira is None:
+                return False
+            if expira < time.time():
+                del self._itens[chave]
+                return False
+            return True
+
+    def registrar(self, chave):
+        expira = time.time() + self.ttl
+        with self._lock:
+            self._guardar(chave, expira)
+            if self.caminho:
+                try:
+                    with self._trava.compartilhado(), open(self.caminho, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps([list(chave), expira]) + '\n')
+                except OSError as e:
+                    print(f"Erro ao gravar {self.caminho}: {str(e)}")
+
+    def _guardar(self, chave, expira):
+        self._itens[chave] = expira
+        self._itens.move_to_end(chave)
+        while len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+
+    def _carregar(self):
+        """Lê os tokens ainda válidos e reescreve o arquivo só com eles.
+
+        Com o lock exclusivo nenhum outro processo está acrescentando ao arquivo
+        antigo durante a troca; sem fcntl (Windows) o arquivo não é compactado.
+        """
+        agora = time.time()
+        try:
+            with self._trava.exclusivo():
+                with open(self.caminho, 'r', encoding='utf-8') as f:
+                    for linha in f:
+                        try:
+                            chave, expira = json.loads(linha)
+                        except ValueError:
+                            continue
+                        if expira >= agora:
+                            self._guardar(tuple(chave), expira)
+                if fcntl is None:
+                    return
+
+                temp_path = f"{self.caminho}.{os.getpid()}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    for chave, expira in self._itens.items():
+                        f.write(json.dumps([list(chave), expira]) + '\n')
+                os.replace(temp_path, self.caminho)
+        except FileNotFoundError:
+            return
+
+
 class QRCodeProcessor:
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    # Até quanto tempo atrás um quiosque autenticado pode informar uma leitura feita offline
+    ATRASO_MAXIMO_OFFLINE = 24 * 3600
+
     def __init__(self):
+        # Validade em segundos; precisa cobrir a janela em que /gerar_qrcode reaproveita o código
+        self.validade = int(os.environ.get('BIBLIOTECA_QR_VALIDADE', 900))
+        # Um token lido offline ainda pode chegar até ATRASO_MAXIMO_OFFLINE depois de expirar
+        self.usados = TokensUsados(self.validade + self.ATRASO_MAXIMO_OFFLINE,
+                                   caminho=os.environ.get('BIBLIOTECA_QR_USADOS') or None)
         self._initialize_strategies()
 
     def _initialize_strategies(self):
@@ -78,28 +203,98 @@ class QRCodeProcessor:
         }
         print("Estratégias de QR Code inicializadas:", self.strategies.keys())  # Log de depuração
 
+    def _resolver(self, qr_data_str, agora=None):
+        """Devolve (strategy, qr_data), ou (None, mensagem de erro). A validade é
+        conferida em relação a agora (padrão: o momento atual)"""
+        # Limpeza da string do QR Code
+        qr_data_str = qr_data_str.strip().strip("('").strip("',)")
+        print(f"Processando QR Code: {qr_data_str}")  # Log de depuração
+
+        if not hasattr(self, 'strategies'):
+            self._initialize_strategies()
+
+        qr_data = QRCodeData.deserialize(qr_data_str)
+        if not qr_data:
+            return None, "QR Code inválido ou corrompido"
+        # Recusados aqui, antes de qualquer leitura do armazenamento
+        if qr_data.expirado(self.validade, agora):
+            return None, "QR Code expirado, gere um novo"
+        if self.usados.contem(qr_data.chave()):
+            return None, "QR Code já utilizado"
+
+        strategy = self.strategies.get(qr_data.qr_type)
+        if not strategy:
+            return None, f"Tipo de QR Code não suportado: {qr_data.qr_type}"
+        return strategy, qr_data
+
     def process(self, qr_data_str: str):
         try:
-            # Limpeza da string do QR Code
-            qr_data_str = qr_data_str.strip().strip("('").strip("',)")
-            print(f"Processando QR Code: {qr_data_str}")  # Log de depuração
-
-            if not hasattr(self, 'strategies'):
-                self._initialize_strategies()
-
-            qr_data = QRCodeData.deserialize(qr_data_str)
-            if not qr_data:
-                return False, "QR Code inválido ou corrompido"
-
-            strategy = self.strategies.get(qr_data.qr_type)
+            strategy, qr_data = self._resolver(qr_data_str)
             if not strategy:
-                return False, f"Tipo de QR Code não suportado: {qr_data.qr_type}"
-
-            return strategy.process(qr_data)
+                return False, qr_data
+            sucesso, mensagem = strategy.process(qr_data)
+            if sucesso:
+                self.usados.registrar(qr_data.chave())
+            return sucesso, mensagem
         except Exception as e:
             print(f"Erro no processamento do QR Code: {str(e)}")  # Log detalhado
             return False, f"Erro no processamento: {str(e)}"
 
+    def process_batch(self, qr_data_strs, lidos_em=None):
+        """Processa várias leituras gravando todas em um único commit.
+
+        lidos_em, se informado, traz o momento de cada leitura (leituras feitas
+        por um quiosque offline valem pela hora em que foram lidas).
+
+        Cada leitura vira uma Transacao própria, então uma falha não desfaz as
+        outras. Se uma leitura depende de outra do mesmo lote (retirada e
+        devolução do mesmo empréstimo), o que já foi agendado é gravado antes,
+        para que ela veja o status atualizado. Devolve [(sucesso, mensagem)].
+        """
+        db = DatabaseSingleton.instance()
+        resultados = []
+        pendentes = []  # (índice em resultados, transação, chave do token)
+        objetos = set()
+        chaves = set()
+
+        def gravar():
+            confirmados = db.commit([tx for _, tx, _ in pendentes])
+            for (indice, _, chave), ok in zip(pendentes, confirmados):
+                if ok:
+                    self.usados.registrar(chave)
+                else:
+                    resultados[indice] = (False, MENSAGEM_CONFLITO)
+            pendentes.clear()
+            objetos.clear()
+
+        for qr_data_str, lido_em in zip(qr_data_strs, lidos_em or [None] * len(qr_data_strs)):
+            try:
+                strategy, qr_data = self._resolver(qr_data_str, lido_em)
+                if not strategy:
+                    resultados.append((False, qr_data))
+                    continue
+                if qr_data.chave() in chaves:
+                    resultados.append((False, "QR Code já utilizado"))
+                    continue
+
+                objeto = (strategy.tabela, qr_data.object_id)
+                if objeto in objetos:
+                    gravar()
+
+                tx = db.transacao()
+                sucesso, mensagem = strategy.preparar(qr_data, tx)
+                resultados.append((sucesso, mensagem))
+                if sucesso:
+                    pendentes.append((len(resultados) - 1, tx, qr_data.chave()))
+                    objetos.add(objeto)
+                    chaves.add(qr_data.chave())
+            except Exception as e:
+                print(f"Erro no processamento do QR Code: {str(e)}")
+                resultados.append((False, f"Erro no processamento: {str(e)}"))
+
+        gravar()
+        return resultados
+
 # Padrão Singleton para Database
 class DatabaseSingleton:
     _instance = None
@@ -112,224 +307,307 @@ class DatabaseSingleton:
         return cls._instance
 
     def _initialize(self):
-        """Inicializa todos os arquivos CSV necessários"""
-        os.makedirs('data', exist_ok=True)
-        for file_type in CSVManager.HEADERS:
-            filename = f"{file_type}.csv"
-            if not os.path.exists(f"data/{filename}") or os.stat(f"data/{filename}").st_size == 0:
-                CSVManager.safe_write(filename, [])
-
-    def _get_next_id(self, filename):
-        data = CSVManager.safe_read(filename)
-        if not data:
-            return 1
-        try:
-            return max(int(row['id']) for row in data) + 1
-        except:
-            return 1
+        """Cria o mecanismo de armazenamento escolhido em BIBLIOTECA_ENGINE (csv ou sqlite)"""
+        engine = os.environ.get('BIBLIOTECA_ENGINE', 'csv').lower()
+        if engine == 'csv':
+            self._engine = CSVEngine()
+        elif engine == 'sqlite':
+            from sqlite_engine import SQLiteEngine
+            self._engine = SQLiteEngine(os.environ.get('BIBLIOTECA_SQLITE_PATH', SQLITE_PATH_PADRAO))
+        else:
+            raise ValueError(f"Mecanismo de armazenamento desconhecido: {engine}")
+
+        self._catalogo = CatalogoIndex()
+        # No SQLite, compartilhado por vários workers, o saldo sai de uma soma
+        # indexada: um cache por processo seria remontado a cada lançamento alheio
+        self._saldos = SaldoConsulta(self._engine) if self._engine.soma_indexada else SaldoCache()
+        self._engine.observar(self._ao_confirmar)
+        self._mapa_de_identidade = lambda: None
+
+    def _ao_confirmar(self, operacoes):
+        """Mantém os índices em memória em dia com as gravações deste processo"""
+        livro_ids = {int(op['row']['id'] if op['op'] == 'inserir' else op['id'])
+                     for op in operacoes if op['tabela'] == 'livros'}
+        if livro_ids:
+            self._catalogo.atualizar(self._engine.get_many('livros', livro_ids).values())
+
+        lancamentos = [op['row'] for op in operacoes if op['tabela'] == 'creditos' and op['op'] == 'inserir']
+        if lancamentos and isinstance(self._saldos, SaldoCache):
+            self._saldos.atualizar(lancamentos)
+
+    def _em_dia(self, indice, tabela):
+        """Remonta o índice em memória se a tabela mudou fora deste processo"""
+        if indice.versao != self._engine.versao(tabela):
+            indice.reconstruir(lambda: (self._engine.versao(tabela), self._engine.linhas(tabela)))
+        return indice
+
+    def _saldos_em_dia(self):
+        if isinstance(self._saldos, SaldoCache):
+            return self._em_dia(self._saldos, 'creditos')
+        return self._saldos
+
+    # Padrão Identity Map para usuários
+    def usar_mapa_de_identidade(self, fornecedor):
+        """fornecedor() devolve o dict do escopo atual (por exemplo, a requisição
+        Flask) onde os usuários já lidos ficam guardados, ou None fora dele"""
+        self._mapa_de_identidade = fornecedor
+
+    def _esquecer_usuario(self, usuario_id):
+        mapa = self._mapa_de_identidade()
+        if mapa is not None:
+            mapa.pop(str(usuario_id), None)
+
+    def observar(self, callback):
+        """callback(operacoes) é chamado após cada commit confirmado neste processo"""
+        self._engine.observar(callback)
+
+    def commit(self, transacoes):
+        """Grava várias transações de uma vez; devolve um bool para cada uma"""
+        return self._engine.commit(transacoes) if transacoes else []
+
+    def transacao(self):
+        """Inicia uma unidade de trabalho; nada é gravado até Transacao.commit()"""
+        return Transacao(self._engine)
 
     # Métodos para usuários
+    def _usuario_from_row(self, row, saldos=None):
+        # A coluna creditos é o saldo de abertura; o restante vem do livro-razão
+        saldos = saldos or self._saldos_em_dia()
+        return Usuario(
+            id=int(row['id']),
+            email=row['email'],
+            senha_hash=row['senha_hash'],
+            creditos=int(row['creditos']) + saldos.saldo(row['id']),
+            tipo=UserType(row.get('tipo', 'normal'))
+        )
+
     def get_usuario_by_email(self, email):
-        usuarios = CSVManager.safe_read('usuarios.csv')
-        for usuario in usuarios:
-            if usuario['email'] == email:
-                return Usuario(
-                    id=int(usuario['id']),
-                    email=usuario['email'],
-                    senha_hash=usuario['senha_hash'],
-                    creditos=int(usuario['creditos']),
-                    tipo=UserType(usuario.get('tipo', 'normal'))
-                )
-        return None
+        row = self._engine.get('usuarios', 'email', email)
+        return self._usuario_from_row(row) if row else None
 
     def get_usuario_by_id(self, usuario_id):
-        usuarios = CSVManager.safe_read('usuarios.csv')
-        for usuario in usuarios:
-            if int(usuario['id']) == usuario_id:
-                return Usuario(
-                    id=int(usuario['id']),
-                    email=usuario['email'],
-                    senha_hash=usuario['senha_hash'],
-                    creditos=int(usuario['creditos']),
-                    tipo=UserType(usuario.get('tipo', 'normal'))
-                )
-        return None
+        mapa = self._mapa_de_identidade()
+        if mapa is not None and str(usuario_id) in mapa:
+            return mapa[str(usuario_id)]
+
+        row = self._engine.get('usuarios', 'id', usuario_id)
+        if not row:
+            return None
+        usuario = self._usuario_from_row(row)
+        if mapa is not None:
+            mapa[str(usuario_id)] = usuario
+        return usuario
 
     def adicionar_usuario(self, usuario):
-        usuarios = CSVManager.safe_read('usuarios.csv')
-        usuario.id = self._get_next_id('usuarios.csv')
-        usuario_dict = {
-            'id': usuario.id,
+        usuario.id = self._engine.inserir('usuarios', {
             'email': usuario.email,
             'senha_hash': usuario.senha_hash,
             'creditos': usuario.creditos,
             'tipo': usuario.tipo.value
-        }
-        usuarios.append(usuario_dict)
-        return CSVManager.safe_write('usuarios.csv', usuarios)
+        })
+        return usuario.id is not None
 
     def get_usuarios(self):
-        usuarios = CSVManager.safe_read('usuarios.csv')
-        return [Usuario(
-            id=int(u['id']),
-            email=u['email'],
-            senha_hash=u['senha_hash'],
-            creditos=int(u['creditos']),
-            tipo=UserType(u.get('tipo', 'normal')))
-            for u in usuarios]
+        saldos = self._saldos_em_dia().todos()
+        return [self._usuario_from_row(u, saldos) for u in self._engine.linhas('usuarios')]
+
+    def atualizar_senha_hash(self, usuario_id, senha_hash):
+        self._esquecer_usuario(usuario_id)
+        return self._engine.atualizar('usuarios', usuario_id, {'senha_hash': senha_hash})
 
     def banir_usuario(self, usuario_id):
-        usuarios = CSVManager.safe_read('usuarios.csv')
-        updated = False
+        self._esquecer_usuario(usuario_id)
+        return self._engine.atualizar('usuarios', usuario_id, {'tipo': UserType.BANIDO.value})
 
-        for usuario in usuarios:
-            if int(usuario['id']) == usuario_id:
-                usuario['tipo'] = UserType.BANIDO.value
-                updated = True
-                break
+    # Métodos para créditos
+    def lancar_creditos(self, usuario_id, delta, motivo, tx=None):
+        """Acrescenta um lançamento ao livro-razão de créditos.
+
+        Débitos só são gravados se o saldo continuar >= 0, o que é conferido no
+        próprio commit. Com tx, o lançamento apenas é agendado nessa transação.
+        """
+        usuario = self._engine.get('usuarios', 'id', usuario_id)
+        if not usuario:
+            return False
 
-        if updated:
-            return CSVManager.safe_write('usuarios.csv', usuarios)
-        return False
+        soma_minima = None
+        if delta < 0:
+            # Os lançamentos não podem consumir mais que o saldo de abertura
+            soma_minima = ('delta', 'usuario_id', -int(usuario['creditos']))
+
+        transacao = tx or self.transacao()
+        transacao.inserir('creditos', {
+            'usuario_id': usuario_id,
+            'delta': delta,
+            'motivo': motivo,
+            'data': datetime.now().isoformat()
+        }, soma_minima=soma_minima)
+        self._esquecer_usuario(usuario_id)
+        return True if tx else transacao.commit()
+
+    def get_extrato_creditos(self, usuario_id):
+        return [{
+            'delta': int(row['delta']),
+            'motivo': row['motivo'],
+            'data': row['data']
+        } for row in self._engine.filtrar('creditos', 'usuario_id', usuario_id)]
 
     # Métodos para livros
+    @staticmethod
+    def _livro_from_row(row):
+        return Livro(
+            id=int(row['id']),
+            titulo=row['titulo'],
+            autor=row['autor'],
+            genero=row['genero'],
+            disponivel=row['disponivel'].lower() == 'true',
+            doador_id=int(row['doador_id']) if row['doador_id'] else None,
+            aprovado=row.get('aprovado', 'false').lower() == 'true'
+        )
+
     def get_livro_by_id(self, livro_id):
-        livros = CSVManager.safe_read('livros.csv')
-        for livro in livros:
-            if int(livro['id']) == livro_id:
-                return Livro(
-                    id=int(livro['id']),
-                    titulo=livro['titulo'],
-                    autor=livro['autor'],
-                    genero=livro['genero'],
-                    disponivel=livro['disponivel'].lower() == 'true',
-                    doador_id=int(livro['doador_id']) if livro['doador_id'] else None,
-                    aprovado=livro.get('aprovado', 'false').lower() == 'true'
-                )
-        return None
+        row = self._engine.get('livros', 'id', livro_id)
+        return self._livro_from_row(row) if row else None
+
+    def get_livros_by_ids(self, livro_ids):
+        """Busca vários livros de uma vez; devolve um dicionário id -> Livro"""
+        rows = self._engine.get_many('livros', set(livro_ids))
+        return {livro_id: self._livro_from_row(row) for livro_id, row in rows.items()}
 
     def get_livros_disponiveis(self):
         livros = []
-        for livro in CSVManager.safe_read('livros.csv'):
+        for livro in self._engine.linhas('livros'):
             if livro['disponivel'].lower() == 'true' and livro.get('aprovado', 'true').lower() == 'true':
-                livros.append(Livro(
-                    id=int(livro['id']),
-                    titulo=livro['titulo'],
-                    autor=livro['autor'],
-                    genero=livro['genero'],
-                    disponivel=True,
-                    doador_id=int(livro['doador_id']) if livro['doador_id'] else None,
-                    aprovado=True
-                ))
+                livros.append(self._livro_from_row(livro))
         return livros
 
-    def adicionar_livro(self, livro):
-        livros = CSVManager.safe_read('livros.csv')
-        livro.id = self._get_next_id('livros.csv')
-        livros.append({
-            'id': livro.id,
+    def buscar_livros(self, q=None, genero=None, autor=None, page=1, page_size=20):
+        """Busca paginada nos livros disponíveis; devolve (livros da página, total)"""
+        catalogo = self._em_dia(self._catalogo, 'livros')
+        ids = catalogo.buscar(q=q, genero=genero, autor=autor)
+        inicio = (page - 1) * page_size
+        pagina = ids[inicio:inicio + page_size]
+        livros = self.get_livros_by_ids(pagina)
+        return [livros[livro_id] for livro_id in pagina if livro_id in livros], len(ids)
+
+    def adicionar_livro(self, livro, tx=None):
+        """Com tx, apenas agenda a inserção; livro.id fica sem valor"""
+        row = {
             'titulo': livro.titulo,
             'autor': livro.autor,
             'genero': livro.genero,
             'disponivel': str(livro.disponivel).lower(),
             'doador_id': livro.doador_id if livro.doador_id else '',
             'aprovado': str(livro.aprovado).lower()
-        })
-        return CSVManager.safe_write('livros.csv', livros)
+        }
+        if tx:
+            tx.inserir('livros', row)
+            return True
+        livro.id = self._engine.inserir('livros', row)
+        return livro.id is not None
 
     # Métodos para empréstimos
+    @staticmethod
+    def _emprestimo_from_row(row):
+        return Emprestimo(
+            id=int(row['id']),
+            usuario_id=int(row['usuario_id']),
+            livro_id=int(row['livro_id']),
+            data_solicitacao=row['data_solicitacao'],
+            data_retirada=row.get('data_retirada'),
+            status=row['status']
+        )
+
     def get_emprestimo_by_id(self, emprestimo_id):
-        emprestimos = CSVManager.safe_read('emprestimos.csv')
-        for emp in emprestimos:
-            if int(emp['id']) == emprestimo_id:
-                return Emprestimo(
-                    id=int(emp['id']),
-                    usuario_id=int(emp['usuario_id']),
-                    livro_id=int(emp['livro_id']),
-                    data_solicitacao=emp['data_solicitacao'],
-                    data_retirada=emp.get('data_retirada'),
-                    status=emp['status']
-                )
-        return None
+        row = self._engine.get('emprestimos', 'id', emprestimo_id)
+        return self._emprestimo_from_row(row) if row else None
 
     def get_emprestimos_por_usuario(self, usuario_id):
+        # Junta empréstimos e livros lendo cada tabela uma única vez
+        do_usuario = self._engine.filtrar('emprestimos', 'usuario_id', usuario_id)
+        livros = self.get_livros_by_ids(int(emp['livro_id']) for emp in do_usuario)
+
         emprestimos = []
-        for emp in CSVManager.safe_read('emprestimos.csv'):
-            if int(emp['usuario_id']) == usuario_id:
-                livro = self.get_livro_by_id(int(emp['livro_id']))
-                if livro:
-                    emprestimos.append({
-                        'id': int(emp['id']),
-                        'livro': livro,
-                        'data_solicitacao': emp['data_solicitacao'],
-                        'status': emp['status']
-                    })
+        for emp in do_usuario:
+            livro = livros.get(int(emp['livro_id']))
+            if livro:
+                emprestimos.append({
+                    'id': int(emp['id']),
+                    'livro': livro,
+                    'data_solicitacao': emp['data_solicitacao'],
+                    'status': emp['status']
+                })
         return emprestimos
 
+    def solicitar_emprestimo(self, emprestimo, custo):
+        """Cria o empréstimo e debita os créditos em um único commit.
+
+        As verificações abaixo só escolhem a mensagem; o commit confere de novo,
+        sob o lock das tabelas, a disponibilidade do livro, a ausência de outro
+        empréstimo ativo para ele e o saldo do usuário.
+        """
+        livro = self._engine.get('livros', 'id', emprestimo.livro_id)
+        if not livro or livro['disponivel'].lower() != 'true' or livro.get('aprovado', 'true').lower() != 'true':
+            return False, "Livro indisponível"
+        if any(emp['status'] in EMPRESTIMO_ATIVO for emp in self._engine.filtrar('emprestimos', 'livro_id', emprestimo.livro_id)):
+            return False, "Livro já reservado"
+        usuario = self.get_usuario_by_id(emprestimo.usuario_id)
+        if not usuario or usuario.creditos < custo:
+            return False, "Créditos insuficientes!"
+
+        tx = self.transacao()
+        tx.conferir('livros', emprestimo.livro_id, {'disponivel': livro['disponivel'], 'aprovado': livro['aprovado']})
+        row = tx.inserir('emprestimos', {
+            'usuario_id': emprestimo.usuario_id,
+            'livro_id': emprestimo.livro_id,
+            'data_solicitacao': emprestimo.data_solicitacao,
+            'data_retirada': emprestimo.data_retirada if emprestimo.data_retirada else '',
+            'status': emprestimo.status
+        }, unico=('livro_id', 'status', EMPRESTIMO_ATIVO))
+        self.lancar_creditos(emprestimo.usuario_id, -custo, 'emprestimo', tx=tx)
+
+        if not tx.commit():
+            return False, "Não foi possível solicitar o empréstimo, tente novamente"
+        emprestimo.id = row['id']
+        return True, "Empréstimo solicitado com sucesso!"
+
     def adicionar_emprestimo(self, emprestimo):
-        emprestimos = CSVManager.safe_read('emprestimos.csv')
-        emprestimo.id = self._get_next_id('emprestimos.csv')
-        emprestimos.append({
-            'id': emprestimo.id,
+        emprestimo.id = self._engine.inserir('emprestimos', {
             'usuario_id': emprestimo.usuario_id,
             'livro_id': emprestimo.livro_id,
             'data_solicitacao': emprestimo.data_solicitacao,
             'data_retirada': emprestimo.data_retirada if emprestimo.data_retirada else '',
             'status': emprestimo.status
         })
-        return CSVManager.safe_write('emprestimos.csv', emprestimos)
+        return emprestimo.id is not None
 
     def cancelar_emprestimo(self, emprestimo_id):
-        emprestimos = CSVManager.safe_read('emprestimos.csv')
-        updated = False
+        return self._engine.atualizar('emprestimos', emprestimo_id, {'status': 'cancelado'},
+                                      esperado={'status': 'pendente'})
 
-        for emp in emprestimos:
-            if int(emp['id']) == emprestimo_id and emp['status'] == 'pendente':
-                emp['status'] = 'cancelado'
-                updated = True
-                break
+    def atualizar_status_emprestimo(self, emprestimo_id, novo_status, tx=None):
+        """Com tx, apenas agenda as alterações nessa transação"""
+        emp = self._engine.get('emprestimos', 'id', emprestimo_id)
+        if not emp:
+            return False
 
-        if updated:
-            return CSVManager.safe_write('emprestimos.csv', emprestimos)
-        return False
-
-    def atualizar_status_emprestimo(self, emprestimo_id, novo_status):
-        emprestimos = CSVManager.safe_read('emprestimos.csv')
-        livros = CSVManager.safe_read('livros.csv')
-        updated = False
-
-        for emp in emprestimos:
-            if int(emp['id']) == emprestimo_id:
-                emp['status'] = novo_status
-
-                if novo_status == 'retirado':
-                    emp['data_retirada'] = datetime.now().isoformat()
-                    for livro in livros:
-                        if int(livro['id']) == int(emp['livro_id']):
-                            livro['disponivel'] = 'False'
-                            break
-
-                elif novo_status == 'devolvido':
-                    for livro in livros:
-                        if int(livro['id']) == int(emp['livro_id']):
-                            livro['disponivel'] = 'True'
-                            break
-
-                updated = True
-                break
+        # Empréstimo e disponibilidade do livro são gravados juntos
+        transacao = tx or self.transacao()
+        campos = {'status': novo_status}
+        if novo_status == 'retirado':
+            campos['data_retirada'] = datetime.now().isoformat()
+        # Falha se outro processo mudou o status depois da leitura acima
+        transacao.atualizar('emprestimos', emprestimo_id, campos, esperado={'status': emp['status']})
 
-        if updated:
-            CSVManager.safe_write('emprestimos.csv', emprestimos)
-            CSVManager.safe_write('livros.csv', livros)
-            return True
-        return False
+        livro_id = int(emp['livro_id'])
+        if novo_status in ('retirado', 'devolvido') and self._engine.get('livros', 'id', livro_id):
+            disponivel = 'False' if novo_status == 'retirado' else 'True'
+            transacao.atualizar('livros', livro_id, {'disponivel': disponivel})
+        return True if tx else transacao.commit()
 
     # Métodos para doações
     def adicionar_doacao(self, doacao):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        doacao.id = self._get_next_id('doacoes.csv')
-        doacao_dict = {
-            'id': doacao.id,
+        doacao.id = self._engine.inserir('doacoes', {
             'usuario_id': doacao.usuario_id,
             'titulo': doacao.titulo,
             'autor': doacao.autor,
@@ -337,96 +615,690 @@ class DatabaseSingleton:
             'data_solicitacao': doacao.data_solicitacao,
             'status': doacao.status,
             'qr_code_data': doacao.qr_code_data if doacao.qr_code_data else ''
-        }
-        doacoes.append(doacao_dict)
-        return CSVManager.safe_write('doacoes.csv', doacoes)
+        })
+        return doacao.id is not None
+
+    @staticmethod
+    def _doacao_from_row(row):
+        return Doacao(
+            id=int(row['id']),
+            usuario_id=int(row['usuario_id']),
+            titulo=row['titulo'],
+            autor=row['autor'],
+            genero=row['genero'],
+            data_solicitacao=row['data_solicitacao'],
+            status=row['status'],
+            qr_code_data=row.get('qr_code_data')
+        )
 
     def get_doacao_by_id(self, doacao_id):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        for doacao in doacoes:
-            if int(doacao['id']) == doacao_id:
-                return Doacao(
-                    id=int(doacao['id']),
-                    usuario_id=int(doacao['usuario_id']),
-                    titulo=doacao['titulo'],
-                    autor=doacao['autor'],
-                    genero=doacao['genero'],
-                    data_solicitacao=doacao['data_solicitacao'],
-                    status=doacao['status'],
-                    qr_code_data=doacao.get('qr_code_data')
-                )
-        return None
+        row = self._engine.get('doacoes', 'id', doacao_id)
+        return self._doacao_from_row(row) if row else None
 
     def get_doacoes_pendentes(self):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        return [Doacao(
-            id=int(d['id']),
-            usuario_id=int(d['usuario_id']),
-            titulo=d['titulo'],
-            autor=d['autor'],
-            genero=d['genero'],
-            data_solicitacao=d['data_solicitacao'],
-            status=d['status'],
-            qr_code_data=d.get('qr_code_data')
-        ) for d in doacoes if d['status'] == 'pendente']
+        doacoes = self._engine.filtrar('doacoes', 'status', 'pendente')
+        return [self._doacao_from_row(d) for d in doacoes]
 
     def get_doacoes_por_usuario(self, usuario_id):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        return [Doacao(
-            id=int(d['id']),
-            usuario_id=int(d['usuario_id']),
-            titulo=d['titulo'],
-            autor=d['autor'],
-            genero=d['genero'],
-            data_solicitacao=d['data_solicitacao'],
-            status=d['status'],
-            qr_code_data=d.get('qr_code_data')
-        ) for d in doacoes if int(d['usuario_id']) == usuario_id]
-
-    def atualizar_status_doacao(self, doacao_id, novo_status):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        updated = False
-
-        for doacao in doacoes:
-            if int(doacao['id']) == doacao_id:
-                doacao['status'] = novo_status
-                updated = True
-                break
-
-        if updated:
-            return CSVManager.safe_write('doacoes.csv', doacoes)
-        return False
+        doacoes = self._engine.filtrar('doacoes', 'usuario_id', usuario_id)
+        return [self._doacao_from_row(d) for d in doacoes]
+
+    def atualizar_status_doacao(self, doacao_id, novo_status, status_atual=None, tx=None):
+        """Com status_atual, só grava se a doação ainda estiver nesse status"""
+        esperado = {'status': status_atual} if status_atual else None
+        if tx:
+            tx.atualizar('doacoes', doacao_id, {'status': novo_status}, esperado)
+            return True
+        return self._engine.atualizar('doacoes', doacao_id, {'status': novo_status}, esperado)
 
     def atualizar_doacao(self, doacao):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        updated = False
-
-        for d in doacoes:
-            if int(d['id']) == doacao.id:
-                d.update({
-                    'status': doacao.status,
-                    'qr_code_data': doacao.qr_code_data if doacao.qr_code_data else ''
-                })
-                updated = True
-                break
-
-        if updated:
-            return CSVManager.safe_write('doacoes.csv', doacoes)
-        return False
+        return self._engine.atualizar('doacoes', doacao.id, {
+            'status': doacao.status,
+            'qr_code_data': doacao.qr_code_data if doacao.qr_code_data else ''
+        })
 
     def atualizar_qr_code_doacao(self, doacao_id, qr_data):
-        doacoes = CSVManager.safe_read('doacoes.csv')
-        updated = False
+        return self._engine.atualizar('doacoes', doacao_id, {'qr_code_data': qr_data})
 
-        for doacao in doacoes:
-            if int(doacao['id']) == doacao_id:
-                doacao['qr_code_data'] = qr_data
-                updated = True
-                break
+    # Registro de transações
+    def registrar_transacoes(self, linhas, max_bytes=None):
+        return self._engine.registrar_transacoes(linhas, max_bytes)
+
+
+# Status em que o livro está com (ou reservado para) um usuário
+EMPRESTIMO_ATIVO = ('pendente', 'retirado')
+
+
+# Padrão Strategy para o mecanismo de armazenamento
+class StorageEngine(ABC):
+    """Operações de baixo nível usadas pelo DatabaseSingleton.
+
+    As linhas trafegam como dicionários de strings com as colunas de
+    CSVManager.HEADERS, qualquer que seja o armazenamento por trás.
+    """
+
+    # True se somar() usa um índice do armazenamento, sem varrer a tabela
+    soma_indexada = False
+
+    def __init__(self):
+        self._observadores = []
+
+    def observar(self, callback):
+        """Registra callback(operacoes), chamado após cada commit confirmado"""
+        self._observadores.append(callback)
+
+    def _notificar(self, operacoes):
+        for callback in self._observadores:
+            callback(operacoes)
+
+    @abstractmethod
+    def versao(self, tabela):
+        """Valor que muda quando a tabela é alterada fora deste engine (outro processo)"""
+
+    @abstractmethod
+    def get(self, tabela, campo, valor):
+        """Primeira linha cujo campo indexado é igual a valor"""
+
+    @abstractmethod
+    def get_many(self, tabela, ids):
+        """Dicionário id -> linha para os ids existentes, em uma única consulta"""
+
+    @abstractmethod
+    def filtrar(self, tabela, campo, valor):
+        """Linhas cujo campo é igual a valor, em ordem de id, via índice secundário"""
+
+    @abstractmethod
+    def linhas(self, tabela):
+        """Todas as linhas da tabela"""
+
+    @abstractmethod
+    def inserir(self, tabela, row):
+        """Insere a linha com um novo id e o retorna (None em caso de erro)"""
+
+    @abstractmethod
+    def atualizar(self, tabela, row_id, campos, esperado=None):
+        """Altera campos da linha; falha se algum valor de esperado não confere"""
+
+    @abstractmethod
+    def commit(self, transacoes):
+        """Confirma uma lista de Transacao e devolve um bool para cada uma"""
+
+    @abstractmethod
+    def registrar_transacoes(self, linhas, max_bytes=None):
+        """Acrescenta linhas ao registro de transações"""
+
+
+# Padrão Unit of Work para alterações em várias tabelas
+class Transacao:
+    """Agrupa inserções e atualizações que devem ser gravadas juntas.
+
+    Nada é escrito antes de commit(). Se alguma linha a atualizar não existir
+    ou não conferir com esperado (comparado ao estado anterior à transação),
+    nenhuma das operações é aplicada.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self.operacoes = []
+
+    def inserir(self, tabela, row, soma_minima=None, unico=None):
+        """Agenda uma inserção; o id gerado fica em row['id'] após o commit.
+
+        soma_minima=(campo, grupo, minimo) faz a transação falhar se a soma de
+        campo nas linhas com o mesmo valor de grupo, contando a nova, ficar
+        abaixo de minimo. unico=(grupo, campo, valores) a faz falhar se outra
+        linha com o mesmo valor de grupo tiver campo em valores.
+        """
+        row = dict(row)
+        self.operacoes.append({
+            'op': 'inserir',
+            'tabela': tabela,
+            'row': row,
+            'soma_minima': soma_minima,
+            'unico': unico
+        })
+        return row
+
+    def atualizar(self, tabela, row_id, campos, esperado=None):
+        self.operacoes.append({
+            'op': 'atualizar',
+            'tabela': tabela,
+            'id': str(row_id),
+            'campos': campos,
+            'esperado': esperado or {}
+        })
+
+    def conferir(self, tabela, row_id, esperado):
+        """Exige que a linha exista e confira com esperado, sem alterá-la"""
+        self.operacoes.append({'op': 'conferir', 'tabela': tabela, 'id': str(row_id), 'esperado': esperado})
+
+    def tabelas(self):
+        return {op['tabela'] for op in self.operacoes}
+
+    def commit(self):
+        return self._engine.commit([self])[0]
+
+
+class CSVEngine(StorageEngine):
+    def __init__(self):
+        super().__init__()
+        os.makedirs('data', exist_ok=True)
+        for file_type in CSVManager.HEADERS:
+            filename = f"{file_type}.csv"
+            if not os.path.exists(f"data/{filename}") or os.stat(f"data/{filename}").st_size == 0:
+                CSVManager.safe_write(filename, [])
+
+        self._travas = {tabela: TableLock(tabela) for tabela in CSVManager.HEADERS}
+        self._caches = {
+            'usuarios': TableCache('usuarios.csv', indices=('id', 'email'), trava=self._travas['usuarios']),
+            'livros': TableCache('livros.csv', trava=self._travas['livros']),
+            'emprestimos': TableCache('emprestimos.csv', agrupamentos=('usuario_id', 'livro_id', 'status'),
+                                      trava=self._travas['emprestimos']),
+            'doacoes': TableCache('doacoes.csv', agrupamentos=('usuario_id', 'status'),
+                                  trava=self._travas['doacoes']),
+            'creditos': TableCache('creditos.csv', agrupamentos=('usuario_id',), trava=self._travas['creditos'])
+        }
+        self._sequencias = {tabela: IdSequence(tabela, cache) for tabela, cache in self._caches.items()}
+
+        self._fila = []
+        self._fila_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        # Commits interrompidos por processos que já terminaram
+        try:
+            with self._commit_lock, self._travar_recuperando(()):
+                pass
+        except IOError as e:
+            print(str(e))
+
+    def versao(self, tabela):
+        return self._caches[tabela].geracao()
+
+    def get(self, tabela, campo, valor):
+        return self._caches[tabela].get(campo, valor)
+
+    def get_many(self, tabela, ids):
+        return self._caches[tabela].get_many('id', ids)
+
+    def filtrar(self, tabela, campo, valor):
+        return self._caches[tabela].filtrar(campo, valor)
+
+    def linhas(self, tabela):
+        return self._caches[tabela].linhas()
+
+    def inserir(self, tabela, row):
+        tx = Transacao(self)
+        row = tx.inserir(tabela, row)
+        return row['id'] if tx.commit() else None
+
+    def atualizar(self, tabela, row_id, campos, esperado=None):
+        tx = Transacao(self)
+        tx.atualizar(tabela, row_id, campos, esperado)
+        return tx.commit()
+
+    def commit(self, transacoes):
+        """Group commit: quem chega enquanto outro commit está em andamento entra
+        na fila, e o próximo a obter o lock grava a fila inteira de uma vez."""
+        pedido = {'transacoes': transacoes, 'resultados': None}
+        with self._fila_lock:
+            self._fila.append(pedido)
+
+        with self._commit_lock:
+            if pedido['resultados'] is None:
+                with self._fila_lock:
+                    lote, self._fila = self._fila, []
+                transacoes = [tx for p in lote for tx in p['transacoes']]
+                # Uma transação com tabela desconhecida falha sozinha, sem derrubar o lote
+                conhecidas = [tx for tx in transacoes if tx.tabelas() <= self._travas.keys()]
+                try:
+                    with self._travar_recuperando(set().union(*(tx.tabelas() for tx in conhecidas))):
+                        aplicadas = dict(zip(map(id, conhecidas), self._aplicar_lote(conhecidas)))
+                except Exception as e:
+                    # Os outros pedidos da fila esperam uma resposta, não a exceção
+                    print(f"Erro no commit: {str(e)}")
+                    aplicadas = {}
+                resultados = [aplicadas.get(id(tx), False) for tx in transacoes]
+                for p in lote:
+                    quantidade = len(p['transacoes'])
+                    p['resultados'], resultados = resultados[:quantidade], resultados[quantidade:]
+        return pedido['resultados']
+
+    @property
+    def journal_path(self):
+        # Um journal por processo, já que vários workers podem gravar ao mesmo tempo
+        return f"data/journal-{os.getpid()}.json"
+
+    @contextmanager
+    def _travar(self, tabelas):
+        """Lock exclusivo nas tabelas, sempre na mesma ordem para evitar deadlock"""
+        with ExitStack() as stack:
+            for tabela in sorted(tabelas):
+                stack.enter_context(self._travas[tabela].exclusivo())
+            yield
+
+    @contextmanager
+    def _travar_recuperando(self, tabelas):
+        """Trava as tabelas e, antes de qualquer commit novo, refaz os journals
+        deixados por processos que morreram no meio de um commit.
+
+        Os journals são relidos com as travas obtidas; se algum toca uma tabela
+        ainda não travada, as travas são liberadas e obtidas de novo com ela
+        (sempre na mesma ordem, para não haver deadlock).
+        """
+        travadas = set(tabelas)
+        while True:
+            with self._travar(travadas):
+                orfaos = self._journals_orfaos()
+                faltando = {op['tabela'] for operacoes in orfaos.values() for op in operacoes} - travadas
+                if not faltando:
+                    for journal_path, operacoes in orfaos.items():
+                        if not self._refazer_journal(journal_path, operacoes):
+                            raise IOError(f"Falha ao recuperar {journal_path}")
+                    yield
+                    return
+            travadas |= faltando
+
+    def _journals_orfaos(self):
+        """{caminho: operações} dos journals cujo processo dono já terminou"""
+        orfaos = {}
+        for journal_path in glob.glob('data/journal-*.json') + glob.glob('data/journal.json'):
+            if self._dono_ativo(journal_path):
+                continue
+            try:
+                with open(journal_path, 'r', encoding='utf-8') as f:
+                    orfaos[journal_path] = json.load(f)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                # O journal é gravado em um .tmp e renomeado, então não fica pela metade
+                print(f"Falha ao ler {journal_path}: {str(e)}")
+        return orfaos
+
+    @staticmethod
+    def _dono_ativo(journal_path):
+        """Se o processo que gravou o journal ainda está rodando (e o commit em andamento)"""
+        pid = re.fullmatch(r'journal-(\d+)\.json', os.path.basename(journal_path))
+        # journal.json de versões anteriores e o journal deste processo, que com
+        # _commit_lock obtido não tem commit em andamento, são sempre órfãos
+        if not pid or int(pid.group(1)) == os.getpid():
+            return False
+        # Sem fcntl (Windows) não há vários processos gravando, e lá os.kill(pid, 0) não é um teste
+        if fcntl is None:
+            return False
+        try:
+            os.kill(int(pid.group(1)), 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _aplicar_lote(self, transacoes):
+        """Chamado com as tabelas envolvidas travadas em modo exclusivo"""
+        trabalho = {}
+        operacoes = []
+        resultados = []
+
+        for tx in transacoes:
+            try:
+                valida = self._validar(tx, trabalho)
+            except Exception as e:
+                # Ex.: valor não numérico em soma_minima; só esta transação falha
+                print(f"Transação inválida: {str(e)}")
+                valida = False
+            if not valida:
+                resultados.append(False)
+                continue
+            operacoes.extend(self._aplicar_em_memoria(tx, trabalho))
+            resultados.append(True)
+
+        # Tabelas apenas conferidas não são gravadas
+        trabalho = {tabela: t for tabela, t in trabalho.items() if t['alterada'] or t['novas']}
+        if not operacoes:
+            return resultados
+
+        # Um append em uma única tabela já é atômico o bastante; reescritas ou
+        # lotes com várias tabelas passam pelo journal antes de tocar os CSVs.
+        usa_journal = len(trabalho) > 1 or any(t['alterada'] for t in trabalho.values())
+        try:
+            if usa_journal:
+                self._gravar_journal(operacoes)
+            for tabela, t in trabalho.items():
+                filename = f"{tabela}.csv"
+                if t['alterada']:
+                    ok = CSVManager.safe_write(filename, t['linhas'])
+                else:
+                    ok = CSVManager.append_rows(filename, t['novas'])
+                if not ok:
+                    raise IOError(f"Falha ao gravar {filename}")
+
+                if t['alterada']:
+                    self._caches[tabela].substituir(t['linhas'], t['base'])
+                else:
+                    self._caches[tabela].anexar(t['novas'], t['base'])
+            if usa_journal:
+                os.remove(self.journal_path)
+        except Exception as e:
+            print(f"Erro no commit: {str(e)}")
+            for tabela in trabalho:
+                self._caches[tabela].invalidar()
+            # Com o journal gravado, refazer as operações conclui o commit
+            if not (usa_journal and os.path.exists(self.journal_path)
+                    and self._refazer_journal(self.journal_path, operacoes)):
+                return [False] * len(resultados)
+
+        self._notificar(operacoes)
+        return resultados
+
+    def _estado(self, tabela, trabalho, com_posicoes=True):
+        """Cópia de trabalho da tabela usada durante o commit do lote"""
+        if tabela not in trabalho:
+            linhas, base = self._caches[tabela].snapshot()
+            trabalho[tabela] = {'linhas': linhas, 'base': base, 'posicoes': None, 'novas': [], 'alterada': False}
+        t = trabalho[tabela]
+        # O mapa id -> posição só é montado quando há atualizações na tabela
+        if com_posicoes and t['posicoes'] is None:
+            t['posicoes'] = {row.get('id'): i for i, row in enumerate(t['linhas'])}
+        return t
+
+    def _validar(self, tx, trabalho):
+        pendentes = []
+        for op in tx.operacoes:
+            if op['op'] == 'inserir':
+                if op['soma_minima'] and not self._soma_valida(op, trabalho, pendentes):
+                    return False
+                if op['unico'] and not self._unico_valido(op, trabalho, pendentes):
+                    return False
+                pendentes.append(op)
+                continue
+            t = self._estado(op['tabela'], trabalho)
+            posicao = t['posicoes'].get(op['id'])
+            if posicao is None:
+                return False
+            row = t['linhas'][posicao]
+            if any(row.get(c) != str(v) for c, v in op['esperado'].items()):
+                return False
+        return True
+
+    def _linhas_do_grupo(self, tabela, grupo, valor, trabalho, pendentes):
+        """Linhas com grupo == valor no estado do lote, mais as inserções
+        anteriores da própria transação"""
+        valor = str(valor)
+        t = self._estado(tabela, trabalho, com_posicoes=False)
+
+        cache = self._caches[tabela]
+        if grupo in cache.campos_agrupados:
+            # O cache está no estado anterior ao lote; o que o lote mudou vem de t
+            linhas = cache.filtrar(grupo, valor)
+            if t['alterada']:
+                linhas = [t['linhas'][t['posicoes'][row['id']]] for row in linhas]
+            linhas += [row for row in t['novas'] if row.get(grupo) == valor]
+        else:
+            linhas = [row for row in t['linhas'] if row.get(grupo) == valor]
+        return linhas + [p['row'] for p in pendentes if p['tabela'] == tabela and str(p['row'].get(grupo)) == valor]
+
+    def _soma_valida(self, op, trabalho, pendentes):
+        campo, grupo, minimo = op['soma_minima']
+        linhas = self._linhas_do_grupo(op['tabela'], grupo, op['row'][grupo], trabalho, pendentes)
+        soma = sum(int(row.get(campo) or 0) for row in linhas) + int(op['row'][campo])
+        return soma >= minimo
+
+    def _unico_valido(self, op, trabalho, pendentes):
+        grupo, campo, valores = op['unico']
+        linhas = self._linhas_do_grupo(op['tabela'], grupo, op['row'][grupo], trabalho, pendentes)
+        return not any(str(row.get(campo)) in valores for row in linhas)
+
+    def _aplicar_em_memoria(self, tx, trabalho):
+        operacoes = []
+        for op in tx.operacoes:
+            tabela = op['tabela']
+            campos_tabela = CSVManager.HEADERS[tabela]
+
+            if op['op'] == 'conferir':
+                continue
+            if op['op'] == 'atualizar':
+                t = self._estado(tabela, trabalho)
+                posicao = t['posicoes'][op['id']]
+                campos = {c: '' if v is None else str(v) for c, v in op['campos'].items()}
+                # Cópia para não alterar linhas que ainda estão no cache
+                t['linhas'][posicao] = {**t['linhas'][posicao], **campos}
+                t['alterada'] = True
+                operacoes.append({'op': 'atualizar', 'tabela': tabela, 'id': op['id'], 'campos': campos})
+            else:
+                t = self._estado(tabela, trabalho, com_posicoes=False)
+                op['row']['id'] = self._sequencias[tabela].proximo()
+                row = {c: '' if op['row'].get(c) is None else str(op['row'][c]) for c in campos_tabela}
+                t['linhas'].append(row)
+                t['novas'].append(row)
+                if t['posicoes'] is not None:
+                    t['posicoes'][row['id']] = len(t['linhas']) - 1
+                operacoes.append({'op': 'inserir', 'tabela': tabela, 'row': row})
+        return operacoes
+
+    def _gravar_journal(self, operacoes):
+        temp_path = f"{self.journal_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(operacoes, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.journal_path)
+
+    def _refazer_journal(self, journal_path, operacoes):
+        """Refaz um commit interrompido; chamado com as tabelas do journal travadas.
+
+        Os valores gravados são absolutos, então o journal só pode ser refeito
+        antes de qualquer commit posterior nessas tabelas (_travar_recuperando).
+        """
+        por_tabela = {}
+        for op in operacoes:
+            por_tabela.setdefault(op['tabela'], []).append(op)
+
+        try:
+            for tabela, ops in por_tabela.items():
+                filename = f"{tabela}.csv"
+                linhas = CSVManager.safe_read(filename)
+                posicoes = {row.get('id'): i for i, row in enumerate(linhas)}
+                for op in ops:
+                    if op['op'] == 'atualizar' and op['id'] in posicoes:
+                        linhas[posicoes[op['id']]].update(op['campos'])
+                    elif op['op'] == 'inserir' and op['row']['id'] not in posicoes:
+                        posicoes[op['row']['id']] = len(linhas)
+                        linhas.append(op['row'])
+                if not CSVManager.safe_write(filename, linhas):
+                    return False
+                self._caches[tabela].invalidar()
+
+            os.remove(journal_path)
+            print(f"Commit interrompido recuperado a partir de {journal_path}")
+            return True
+        except Exception as e:
+            print(f"Falha ao recuperar {journal_path}: {str(e)}")
+            return False
+
+    def registrar_transacoes(self, linhas, max_bytes=None):
+        with self._travas['transacoes'].exclusivo():
+            if max_bytes:
+                self._rotacionar_transacoes(max_bytes)
+            return CSVManager.append_rows('transacoes.csv', linhas)
+
+    def _rotacionar_transacoes(self, max_bytes):
+        """Renomeia transacoes.csv para transacoes-<dia>.csv quando passa do
+        tamanho máximo ou quando foi escrito pela última vez em outro dia"""
+        filepath = CSVManager.filepath('transacoes.csv')
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return
+
+        cabecalho = len(','.join(CSVManager.HEADERS['transacoes'])) + 2
+        dia = datetime.fromtimestamp(st.st_mtime).date()
+        if st.st_size <= cabecalho or (st.st_size < max_bytes and dia == datetime.now().date()):
+            return
+
+        base = filepath[:-len('.csv')]
+        destino = f"{base}-{dia.isoformat()}.csv"
+        sequencia = 1
+        while os.path.exists(destino):
+            destino = f"{base}-{dia.isoformat()}.{sequencia}.csv"
+            sequencia += 1
+
+        try:
+            os.rename(filepath, destino)
+        except OSError as e:
+            print(f"Erro ao rotacionar {filepath}: {str(e)}")
+
+
+class IndiceEmMemoria(ABC):
+    """Estrutura derivada de uma tabela e mantida em memória.
+
+    É montada uma vez a partir da tabela e depois atualizada linha a linha a
+    cada gravação (DatabaseSingleton._ao_confirmar); só volta a ser montada
+    quando a tabela muda fora do processo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.versao = None
+        self._alteracoes = 0
+        self._limpar()
+
+    @abstractmethod
+    def _limpar(self):
+        pass
+
+    @abstractmethod
+    def _indexar(self, row):
+        pass
+
+    def reconstruir(self, carregar):
+        """carregar() devolve (versao, linhas). Se alguma gravação chegar durante
+        a leitura, a montagem é refeita para não perdê-la."""
+        while True:
+            with self._lock:
+                alteracoes = self._alteracoes
+            versao, linhas = carregar()
+            with self._lock:
+                if alteracoes != self._alteracoes:
+                    continue
+                self._limpar()
+                for row in linhas:
+                    self._indexar(row)
+                self.versao = versao
+                return
+
+    def atualizar(self, linhas):
+        with self._lock:
+            self._alteracoes += 1
+            if self.versao is None:
+                return
+            for row in linhas:
+                self._indexar(row)
+
+
+# Índice invertido para a busca no catálogo
+class CatalogoIndex(IndiceEmMemoria):
+    """Índice token -> ids sobre titulo, autor e genero dos livros"""
+
+    def _limpar(self):
+        self._tokens = {}
+        self._autor = {}
+        self._genero = {}
+        self._tokens_do_livro = {}
+        self._disponiveis = set()
+
+    @staticmethod
+    def normalizar(texto):
+        texto = unicodedata.normalize('NFKD', texto or '')
+        return texto.encode('ascii', 'ignore').decode('ascii').lower().strip()
+
+    @classmethod
+    def tokens(cls, texto):
+        return set(re.findall(r'\w+', cls.normalizar(texto)))
+
+    def _indexar(self, row):
+        livro_id = int(row['id'])
+        self._remover(livro_id)
+
+        grupos = [
+            (self._tokens, self.tokens(f"{row['titulo']} {row['autor']} {row['genero']}")),
+            (self._autor, self.tokens(row['autor'])),
+            (self._genero, {self.normalizar(row['genero'])})
+        ]
+        for indice, chaves in grupos:
+            for chave in chaves:
+                indice.setdefault(chave, set()).add(livro_id)
+        self._tokens_do_livro[livro_id] = grupos
+
+        # Mesmo critério de get_livros_disponiveis
+        if row['disponivel'].lower() == 'true' and row.get('aprovado', 'true').lower() == 'true':
+            self._disponiveis.add(livro_id)
+
+    def _remover(self, livro_id):
+        for indice, chaves in self._tokens_do_livro.pop(livro_id, []):
+            for chave in chaves:
+                ids = indice.get(chave)
+                if ids is not None:
+                    ids.discard(livro_id)
+                    if not ids:
+                        del indice[chave]
+        self._disponiveis.discard(livro_id)
+
+    @staticmethod
+    def _com_prefixo(indice, token):
+        """Ids cujos tokens começam com token (o vocabulário é bem menor que o acervo)"""
+        ids = set()
+        for chave, livros in indice.items():
+            if chave.startswith(token):
+                ids |= livros
+        return ids
+
+    def buscar(self, q=None, genero=None, autor=None):
+        """Ids dos livros disponíveis que atendem a todos os filtros, em ordem"""
+        with self._lock:
+            conjuntos = [self._disponiveis]
+            conjuntos += [self._com_prefixo(self._tokens, token) for token in self.tokens(q)]
+            conjuntos += [self._com_prefixo(self._autor, token) for token in self.tokens(autor)]
+            if genero:
+                conjuntos.append(self._genero.get(self.normalizar(genero), set()))
+
+            conjuntos.sort(key=len)
+            ids = set(conjuntos[0]).intersection(*conjuntos[1:])
+            return sorted(ids)
+
+
+class SaldoCache(IndiceEmMemoria):
+    """Soma dos lançamentos do livro-razão de créditos por usuário"""
+
+    def _limpar(self):
+        self._saldos = {}
+
+    def _indexar(self, row):
+        usuario_id = int(row['usuario_id'])
+        self._saldos[usuario_id] = self._saldos.get(usuario_id, 0) + int(row['delta'])
+
+    def saldo(self, usuario_id):
+        with self._lock:
+            return self._saldos.get(int(usuario_id), 0)
+
+    def todos(self):
+        return self
+
+
+class SaldoConsulta:
+    """Mesma interface do SaldoCache, mas cada saldo é somado no armazenamento"""
+
+    def __init__(self, engine, somas=None):
+        self._engine = engine
+        self._somas = somas
+
+    def todos(self):
+        """Saldos de todos os usuários somados de uma vez (GROUP BY), para listas"""
+        return SaldoConsulta(self._engine, self._engine.somar_por_grupo('creditos', 'delta', 'usuario_id'))
+
+    def saldo(self, usuario_id):
+        if self._somas is not None:
+            return self._somas.get(int(usuario_id), 0)
+        return self._engine.somar('creditos', 'delta', 'usuario_id', usuario_id)
 
-        if updated:
-            return CSVManager.safe_write('doacoes.csv', doacoes)
-        return False
 
 # Padrão Factory para QR Code Generator
 class QRCodeGenerator:
@@ -457,56 +1329,239 @@ class QRCodeGenerator:
         return qr.make_image(fill_color=fill_color, back_color=back_color)
 
 
-# Padrão Facade para o sistema de créditos
-class CreditSystem:
-    def adicionar_creditos(self, usuario_id, quantidade):
-        db = DatabaseSingleton.instance()
-        usuario = db.get_usuario_by_id(usuario_id)
-        if not usuario:
-            return False
+class QRCodePNGCache:
+    """LRU dos PNGs de QR Code já renderizados.
 
-        usuario.creditos += quantidade
-        return self._atualizar_usuario(usuario)
+    A chave é (tipo, object_id, user_id, janela); as entradas de um empréstimo
+    ou doação são descartadas quando seu status muda (ao_confirmar).
+    """
 
-    def deduzir_creditos(self, usuario_id, quantidade):
-        db = DatabaseSingleton.instance()
-        usuario = db.get_usuario_by_id(usuario_id)
-        if not usuario or usuario.creditos < quantidade:
-            return False
+    TIPOS_POR_TABELA = {
+        'emprestimos': (QRCodeType.EMPRESTIMO.name, QRCodeType.DEVOLUCAO.name),
+        'doacoes': (QRCodeType.DOACAO.name,)
+    }
+
+    def __init__(self, max_itens=256):
+        self.max_itens = max_itens
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            png = self._itens.get(chave)
+            if png is not None:
+                self._itens.move_to_end(chave)
+            return png
+
+    def put(self, chave, png):
+        with self._lock:
+            self._itens[chave] = png
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def invalidar(self, tipo, object_id):
+        with self._lock:
+            for chave in [c for c in self._itens if c[0] == tipo and c[1] == object_id]:
+                del self._itens[chave]
+
+    def ao_confirmar(self, operacoes):
+        for op in operacoes:
+            tipos = self.TIPOS_POR_TABELA.get(op['tabela'], ())
+            if op['op'] == 'atualizar' and 'status' in op['campos']:
+                for tipo in tipos:
+                    self.invalidar(tipo, int(op['id']))
 
-        usuario.creditos -= quantidade
-        return self._atualizar_usuario(usuario)
+
+# Padrão Facade para o sistema de créditos
+class CreditSystem:
+    def adicionar_creditos(self, usuario_id, quantidade, motivo='credito'):
+        return DatabaseSingleton.instance().lancar_creditos(usuario_id, quantidade, motivo)
+
+    def deduzir_creditos(self, usuario_id, quantidade, motivo='debito'):
+        """Confere o saldo e debita de forma atômica; sem saldo, nada é debitado"""
+        return DatabaseSingleton.instance().lancar_creditos(usuario_id, -quantidade, motivo)
 
     def tem_creditos_suficientes(self, usuario_id, quantidade):
         db = DatabaseSingleton.instance()
         usuario = db.get_usuario_by_id(usuario_id)
         return usuario and usuario.creditos >= quantidade
 
-    def _atualizar_usuario(self, usuario):
-        db = DatabaseSingleton.instance()
-        usuarios = CSVManager.safe_read('usuarios.csv')
-        updated = False
+    def extrato(self, usuario_id):
+        return DatabaseSingleton.instance().get_extrato_creditos(usuario_id)
+
+
+class PoolSobrecarregado(Exception):
+    """A fila do BcryptPool está cheia"""
+
 
-        for u in usuarios:
-            if int(u['id']) == usuario.id:
-                u['creditos'] = usuario.creditos
-                updated = True
+class BcryptPool:
+    """Executa o bcrypt fora da thread da requisição, em um pool limitado.
+
+    Configurado por BIBLIOTECA_BCRYPT_CUSTO, BIBLIOTECA_BCRYPT_WORKERS e
+    BIBLIOTECA_BCRYPT_FILA. Com workers ocupados e a fila cheia, executar()
+    levanta PoolSobrecarregado em vez de enfileirar mais trabalho.
+    """
+
+    def __init__(self, workers=None, max_fila=None, custo=None):
+        self.workers = workers or int(os.environ.get('BIBLIOTECA_BCRYPT_WORKERS', min(4, os.cpu_count() or 1)))
+        self.max_fila = max_fila if max_fila is not None else int(os.environ.get('BIBLIOTECA_BCRYPT_FILA', 32))
+        self.custo = custo or int(os.environ.get('BIBLIOTECA_BCRYPT_CUSTO', 12))
+        self._vagas = threading.BoundedSemaphore(self.workers + self.max_fila)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+
+    def executar(self, funcao, *args, **kwargs):
+        """Roda funcao no pool e espera o resultado"""
+        if not self._vagas.acquire(blocking=False):
+            raise PoolSobrecarregado()
+        try:
+            futuro = self._executor.submit(funcao, *args, **kwargs)
+        except Exception:
+            self._vagas.release()
+            raise
+        futuro.add_done_callback(lambda _: self._vagas.release())
+        return futuro.result()
+
+    def criar_usuario(self, email, senha):
+        return self.executar(Usuario.criar_usuario, email, senha, custo=self.custo)
+
+    def verificar_senha(self, usuario, senha):
+        return self.executar(usuario.verificar_senha, senha)
+
+    def precisa_rehash(self, usuario):
+        return usuario.custo_do_hash() != self.custo
+
+    def gerar_hash(self, senha):
+        return self.executar(Usuario.gerar_hash, senha, self.custo)
+
+
+class LoginThrottle:
+    """Limita tentativas de login com um token bucket por IP e outro por email.
+
+    Os buckets ficam em um LRU limitado a max_chaves; os que ficam ociosos por
+    mais de ttl segundos (tempo para encherem de novo) são descartados.
+    """
+
+    def __init__(self, capacidade_ip=20, capacidade_email=5, por_minuto=5, max_chaves=10000):
+        self.capacidades = {'ip': capacidade_ip, 'email': capacidade_email}
+        self.taxa = por_minuto / 60.0
+        self.max_chaves = max_chaves
+        self.ttl = max(self.capacidades.values()) / self.taxa
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.permitidas = 0
+        self.rejeitadas = 0
+
+    def permitir(self, ip, email):
+        """Consome uma ficha do IP e do email; False se algum dos dois esgotou"""
+        agora = time.monotonic()
+        chaves = [('ip', ip or ''), ('email', (email or '').lower())]
+        with self._lock:
+            self._expirar(agora)
+            buckets = [self._bucket(chave, agora) for chave in chaves]
+            if all(bucket[0] >= 1 for bucket in buckets):
+                for bucket in buckets:
+                    bucket[0] -= 1
+                self.permitidas += 1
+                return True
+            self.rejeitadas += 1
+            return False
+
+    def _bucket(self, chave, agora):
+        bucket = self._buckets.get(chave)
+        capacidade = self.capacidades[chave[0]]
+        if bucket is None:
+            bucket = [capacidade, agora]
+            self._buckets[chave] = bucket
+            if len(self._buckets) > self.max_chaves:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0] = min(capacidade, bucket[0] + (agora - bucket[1]) * self.taxa)
+            bucket[1] = agora
+            self._buckets.move_to_end(chave)
+        return bucket
+
+    def _expirar(self, agora):
+        # Em ordem de uso: o primeiro ainda dentro do ttl encerra a varredura
+        while self._buckets:
+            chave, bucket = next(iter(self._buckets.items()))
+            if agora - bucket[1] < self.ttl:
                 break
+            del self._buckets[chave]
 
-        if updated:
-            return CSVManager.safe_write('usuarios.csv', usuarios)
-        return False
+    def estatisticas(self):
+        with self._lock:
+            return {'permitidas': self.permitidas, 'rejeitadas': self.rejeitadas, 'chaves': len(self._buckets)}
 
 
 # Padrão Observer para Logger
 class Logger:
+    """Registro de transações com buffer em memória e escrita em segundo plano.
+
+    As mensagens são acumuladas e gravadas por append quando o buffer enche ou
+    a cada intervalo. No armazenamento CSV o arquivo ativo é rotacionado por
+    tamanho ou quando o dia muda, mantendo o esquema data,mensagem.
+    """
+
+    def __init__(self, max_buffer=100, intervalo=1.0, max_bytes=5 * 1024 * 1024):
+        self.max_buffer = max_buffer
+        self.intervalo = intervalo
+        self.max_bytes = max_bytes
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._escrita_lock = threading.Lock()
+        self._fechado = False
+
+        self._thread = threading.Thread(target=self._loop, name='Logger', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
     def log(self, mensagem):
-        transacoes = CSVManager.safe_read('transacoes.csv')
-        transacoes.append({
-            'data': datetime.now().isoformat(),
-            'mensagem': mensagem
-        })
-        CSVManager.safe_write('transacoes.csv', transacoes)
+        with self._cond:
+            self._buffer.append({
+                'data': datetime.now().isoformat(),
+                'mensagem': mensagem
+            })
+            cheio = len(self._buffer) >= self.max_buffer
+            if cheio:
+                self._cond.notify()
+            fechado = self._fechado
+
+        if fechado:
+            self.flush()
+
+    def flush(self):
+        """Grava imediatamente tudo o que estiver no buffer"""
+        with self._escrita_lock:
+            with self._cond:
+                linhas, self._buffer = self._buffer, []
+            if not linhas:
+                return True
+
+            if DatabaseSingleton.instance().registrar_transacoes(linhas, self.max_bytes):
+                return True
+
+            # Mantém as mensagens para a próxima tentativa
+            with self._cond:
+                self._buffer[:0] = linhas
+            return False
+
+    def close(self):
+        with self._cond:
+            self._fechado = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if not self._fechado and len(self._buffer) < self.max_buffer:
+                    self._cond.wait(self.intervalo)
+                fechado = self._fechado
+            self.flush()
+            if fechado:
+                return
 
 
 # Padrão Factory para criação de livros
@@ -532,18 +1587,27 @@ class CSVManager:
         'livros': ['id', 'titulo', 'autor', 'genero', 'disponivel', 'doador_id', 'aprovado'],
         'emprestimos': ['id', 'usuario_id', 'livro_id', 'data_solicitacao', 'data_retirada', 'status'],
         'transacoes': ['data', 'mensagem'],
-        'doacoes': ['id', 'usuario_id', 'titulo', 'autor', 'genero', 'data_solicitacao', 'status', 'qr_code_data']
+        'doacoes': ['id', 'usuario_id', 'titulo', 'autor', 'genero', 'data_solicitacao', 'status', 'qr_code_data'],
+        'creditos': ['id', 'usuario_id', 'delta', 'motivo', 'data']
     }
 
+    @staticmethod
+    def file_type(filename):
+        return filename.replace('.csv', '').replace('data/', '')
+
+    @staticmethod
+    def filepath(filename):
+        return f"data/{filename}" if not filename.startswith('data/') else filename
+
     @classmethod
     def safe_write(cls, filename, data):
         """Escreve dados em CSV de forma segura e atômica"""
-        file_type = filename.replace('.csv', '').replace('data/', '')
+        file_type = cls.file_type(filename)
 
         if file_type not in cls.HEADERS:
             raise ValueError(f"Tipo de arquivo desconhecido: {filename}")
 
-        filepath = f"data/{filename}" if not filename.startswith('data/') else filename
+        filepath = cls.filepath(filename)
         temp_path = f"{filepath}.tmp"
 
         try:
@@ -554,6 +1618,8 @@ class CSVManager:
                 writer.writeheader()
                 if data:
                     writer.writerows(data)
+                f.flush()
+                os.fsync(f.fileno())
 
             os.replace(temp_path, filepath)
             return True
@@ -563,11 +1629,47 @@ class CSVManager:
                 os.remove(temp_path)
             return False
 
+    @classmethod
+    def append_rows(cls, filename, rows):
+        """Acrescenta linhas ao final do CSV sem reescrever o arquivo"""
+        file_type = cls.file_type(filename)
+
+        if file_type not in cls.HEADERS:
+            raise ValueError(f"Tipo de arquivo desconhecido: {filename}")
+
+        filepath = cls.filepath(filename)
+
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            novo = not os.path.exists(filepath) or os.path.getsize(filepath) == 0
+            quebra_pendente = not novo and not cls._termina_com_quebra(filepath)
+
+            with open(filepath, 'a', newline='', encoding='utf-8') as f:
+                if quebra_pendente:
+                    # Última linha ficou incompleta (ex.: queda durante uma escrita)
+                    f.write('\r\n')
+                writer = csv.DictWriter(f, fieldnames=cls.HEADERS[file_type])
+                if novo:
+                    writer.writeheader()
+                writer.writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            return True
+        except Exception as e:
+            print(f"Erro ao acrescentar em {filename}: {str(e)}")
+            return False
+
+    @staticmethod
+    def _termina_com_quebra(filepath):
+        with open(filepath, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
     @classmethod
     def safe_read(cls, filename):
         """Lê um arquivo CSV com tratamento de erros robusto"""
-        file_type = filename.replace('.csv', '').replace('data/', '')
-        filepath = f"data/{filename}" if not filename.startswith('data/') else filename
+        file_type = cls.file_type(filename)
+        filepath = cls.filepath(filename)
 
         if not os.path.exists(filepath):
             return []
@@ -594,4 +1696,240 @@ class CSVManager:
             return True
         except Exception as e:
             print(f"Falha ao reparar {filepath}: {str(e)}")
-            return False
\ No newline at end of file
+            return False
+
+# Cache em memória para as tabelas CSV
+class TableCache:
+    """Mantém as linhas já parseadas de uma tabela com índices hash por campo.
+
+    Os campos de indices são únicos (valor -> linha); os de agrupamentos são
+    índices secundários (valor -> linhas com aquele valor, em ordem de id).
+
+    O arquivo só é relido quando sua assinatura (mtime, tamanho, inode) muda,
+    de modo que escritas feitas por outros processos continuam visíveis.
+    """
+
+    def __init__(self, filename, indices=('id',), agrupamentos=(), trava=None):
+        self.filename = filename
+        self.filepath = CSVManager.filepath(filename)
+        self.campos_indexados = tuple(indices)
+        self.campos_agrupados = tuple(agrupamentos)
+        self.trava = trava or TableLock(CSVManager.file_type(filename))
+        # Mesmo lock de threads da trava da tabela: quem grava a tabela já o detém
+        self._lock = self.trava.thread_lock
+        self._assinatura = None
+        self._linhas = []
+        self._indices = {campo: {} for campo in self.campos_indexados}
+        self._grupos = {campo: {} for campo in self.campos_agrupados}
+        self._max_id = 0
+        self._geracao = 0
+
+    def _assinatura_arquivo(self):
+        try:
+            st = os.stat(self.filepath)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _atualizar(self):
+        assinatura = self._assinatura_arquivo()
+        if assinatura is not None and assinatura == self._assinatura:
+            return
+
+        # A assinatura é lida antes do arquivo: se ele mudar durante a
+        # leitura, a próxima consulta detecta a diferença e recarrega.
+        with self.trava.compartilhado():
+            self._indexar(CSVManager.safe_read(self.filename))
+        self._assinatura = assinatura
+        self._geracao += 1
+
+    def _indexar(self, linhas):
+        self._linhas = []
+        self._indices = {campo: {} for campo in self.campos_indexados}
+        self._grupos = {campo: {} for campo in self.campos_agrupados}
+        self._max_id = 0
+        for row in linhas:
+            self._acrescentar(row)
+
+    def _acrescentar(self, row):
+        self._linhas.append(row)
+        for campo, indice in self._indices.items():
+            valor = row.get(campo)
+            if valor:
+                indice.setdefault(valor, row)
+        # Cada grupo é um dict id -> linha: mantém a ordem do arquivo e
+        # permite trocar a linha de um id sem percorrer o grupo
+        for campo, grupos in self._grupos.items():
+            grupos.setdefault(row.get(campo), {}).setdefault(row.get('id'), row)
+        self._max_id = max(self._max_id, self._id_da_linha(row))
+
+    def _id_da_linha(self, row):
+        try:
+            return int(row.get('id') or 0)
+        except ValueError:
+            print(f"Id inválido em {self.filename}: {row.get('id')!r}")
+            return 0
+
+    def get(self, campo, valor):
+        """Busca O(1) de uma linha pelo valor de um campo indexado"""
+        with self._lock:
+            self._atualizar()
+            return self._indices[campo].get(str(valor))
+
+    def filtrar(self, campo, valor):
+        """Linhas com campo == valor pelo índice secundário, em O(resultados)"""
+        with self._lock:
+            self._atualizar()
+            return list(self._grupos[campo].get(str(valor), {}).values())
+
+    def geracao(self):
+        """Conta as recargas do arquivo; escritas do próprio processo via
+        anexar/substituir não a alteram"""
+        with self._lock:
+            self._atualizar()
+            return self._geracao
+
+    def get_many(self, campo, valores):
+        """Várias buscas pelo índice com uma única verificação do arquivo"""
+        with self._lock:
+            self._atualizar()
+            indice = self._indices[campo]
+            encontrados = {}
+            for valor in valores:
+                row = indice.get(str(valor))
+                if row:
+                    encontrados[valor] = row
+            return encontrados
+
+    def linhas(self):
+        with self._lock:
+            self._atualizar()
+            return list(self._linhas)
+
+    def snapshot(self):
+        """Linhas atuais e a assinatura do arquivo a que correspondem"""
+        with self._lock:
+            self._atualizar()
+            return list(self._linhas), self._assinatura
+
+    def anexar(self, novas, base):
+        """Reflete em memória linhas acrescentadas ao arquivo pelo próprio processo.
+
+        Só vale se o cache ainda corresponde à assinatura base (lida antes da
+        escrita); caso contrário a próxima leitura recarrega o arquivo inteiro.
+        """
+        with self._lock:
+            if self._assinatura is None or self._assinatura != base:
+                return
+            for row in novas:
+                self._acrescentar(row)
+            self._assinatura = self._assinatura_arquivo()
+
+    def substituir(self, linhas, base):
+        """Como anexar, mas para um arquivo reescrito por inteiro"""
+        with self._lock:
+            if self._assinatura is None or self._assinatura != base:
+                return
+            self._indexar(linhas)
+            self._assinatura = self._assinatura_arquivo()
+
+    def invalidar(self):
+        with self._lock:
+            self._assinatura = None
+
+    def max_id(self, recarregar=False):
+        """Maior id conhecido; sem recarregar, usa apenas o que já está em memória"""
+        with self._lock:
+            if recarregar:
+                self._atualizar()
+            return self._max_id
+
+
+class TableLock:
+    """Lock de leitura/escrita de uma tabela, válido entre processos.
+
+    Usa fcntl.flock em data/<tabela>.lock: compartilhado para quem lê o CSV e
+    exclusivo para quem grava, o que permite rodar vários workers do gunicorn
+    ao lado do leitor de QR. Dentro do processo as threads são serializadas
+    por um RLock, e o mesmo thread pode entrar de novo na trava que já detém.
+    Sem fcntl (Windows) resta apenas o RLock.
+    """
+
+    def __init__(self, tabela, filepath=None):
+        self.filepath = filepath or f"data/{tabela}.lock"
+        self.thread_lock = threading.RLock()
+        self._fd = None
+        self._pid = None
+        self._modo = None
+
+    def compartilhado(self):
+        return self._adquirir(exclusivo=False)
+
+    def exclusivo(self):
+        return self._adquirir(exclusivo=True)
+
+    @contextmanager
+    def _adquirir(self, exclusivo):
+        with self.thread_lock:
+            anterior = self._modo
+            modo = 'exclusivo' if exclusivo or anterior == 'exclusivo' else 'compartilhado'
+            if modo != anterior:
+                self._flock(modo)
+            self._modo = modo
+            try:
+                yield
+            finally:
+                self._modo = anterior
+                if anterior != modo:
+                    self._flock(anterior)
+
+    def _flock(self, modo):
+        if fcntl is None:
+            return
+        # Um descritor herdado via fork compartilharia o lock com o processo pai
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        operacao = {'exclusivo': fcntl.LOCK_EX, 'compartilhado': fcntl.LOCK_SH, None: fcntl.LOCK_UN}[modo]
+        fcntl.flock(self._fd, operacao)
+
+
+class IdSequence:
+    """Sequência persistente de ids de uma tabela, guardada em data/<tabela>.seq.
+
+    Cada alocação lê e grava apenas esse arquivo; a tabela só é varrida para
+    reconstruir a sequência quando o arquivo não existe ou está corrompido.
+    """
+
+    def __init__(self, tabela, cache):
+        self.filepath = f"data/{tabela}.seq"
+        self.cache = cache
+        self._lock = threading.Lock()
+
+    def proximo(self):
+        with self._lock:
+            ultimo = self._ler()
+            if ultimo is None:
+                ultimo = self.cache.max_id(recarregar=True)
+            # Protege contra um .seq defasado em relação ao que já foi carregado
+            novo = max(ultimo, self.cache.max_id()) + 1
+            self._gravar(novo)
+            return novo
+
+    def _ler(self):
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            print(f"Sequência corrompida em {self.filepath} - reconstruindo")
+            return None
+
+    def _gravar(self, valor):
+        temp_path = f"{self.filepath}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(str(valor))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.filepath)